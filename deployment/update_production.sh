@@ -21,12 +21,15 @@ sudo -H -u evap ./manage.py compilemessages
 sudo -H -u evap ./manage.py collectstatic --noinput
 sudo -H -u evap ./manage.py compress --verbosity=0
 sudo -H -u evap ./manage.py migrate
+sudo -H -u evap ./manage.py createcachetable
 # reload only after static files are updated, so the new code finds all the files it expects.
 # also, reload after migrations happened. see https://github.com/fsr-itse/EvaP/pull/817 for a discussion.
 sudo service apache2 reload
 # update caches. this can take minutes but doesn't need a reload.
-sudo -H -u evap ./manage.py clear_cache
+sudo -H -u evap ./manage.py clear_cache --cache default --cache rendered_results
 sudo -H -u evap ./manage.py refresh_results_cache
+# store the grades of published courses that don't have them yet, e.g. because they were published before the grades were stored.
+sudo -H -u evap ./manage.py warm_up_results_cache
 
 { set +x; } 2>/dev/null # don't print the echo command, and don't print the 'set +x' itself
 
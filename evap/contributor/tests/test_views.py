@@ -1,6 +1,6 @@
 from model_mommy import mommy
 
-from evap.evaluation.models import Course, UserProfile
+from evap.evaluation.models import Course, Question, RatingAnswerCounter, UserProfile
 from evap.evaluation.tests.tools import ViewTest, create_course_with_responsible_and_editor
 
 TESTING_COURSE_ID = 2
@@ -33,6 +33,25 @@ class TestContributorSettingsView(ViewTest):
         self.assertEqual(list(UserProfile.objects.get(username='responsible').delegates.all()), [user])
 
 
+class TestContributorResultsTrendsView(ViewTest):
+    url = '/contributor/results'
+    test_users = ['editor', 'responsible']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = create_course_with_responsible_and_editor()
+
+    def test_shows_published_results(self):
+        Course.objects.filter(pk=self.course.pk).update(state='published', _participant_count=3, _voter_count=3)
+        contribution = self.course.contributions.get(contributor__username='editor')
+        question = mommy.make(Question, questionnaire=contribution.questionnaires.get(), type="G", text_en="Question about the editor")
+        mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=2, count=3)
+
+        page = self.app.get(self.url, user='editor')
+        self.assertIn("Question about the editor", page)
+        self.assertNotIn("Question about the editor", self.app.get(self.url, user='responsible'))
+
+
 class TestContributorCourseView(ViewTest):
     url = '/contributor/course/%s' % TESTING_COURSE_ID
     test_users = ['editor', 'responsible']
@@ -9,7 +9,7 @@ from evap.contributor.forms import CourseForm, DelegatesForm, EditorContribution
 from evap.evaluation.auth import contributor_or_delegate_required, editor_or_delegate_required, editor_required
 from evap.evaluation.models import Contribution, Course, Semester
 from evap.evaluation.tools import STATES_ORDERED, sort_formset
-from evap.results.tools import calculate_average_grades_and_deviation
+from evap.results.tools import calculate_average_grades_and_deviation_for_courses, get_contributor_trends
 from evap.staff.forms import ContributionFormSet
 from evap.student.views import vote_preview
 
@@ -27,9 +27,10 @@ def index(request):
     all_courses = list(own_courses) + list(delegated_courses)
     all_courses.sort(key=lambda course: list(STATES_ORDERED.keys()).index(course.state))
 
-    for course in all_courses:
-        if course.state == 'published':
-            course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation(course)
+    published_courses = [course for course in all_courses if course.state == 'published']
+    average_grades_and_deviations = calculate_average_grades_and_deviation_for_courses(published_courses)
+    for course in published_courses:
+        course.avg_grade, course.avg_deviation = average_grades_and_deviations[course.id]
 
     semesters = Semester.objects.all()
     semester_list = [dict(
@@ -43,6 +44,14 @@ def index(request):
     return render(request, "contributor_index.html", template_data)
 
 
+@contributor_or_delegate_required
+def results_trends(request):
+    semesters, questionnaire_trends = get_contributor_trends(request.user)
+
+    template_data = dict(semesters=semesters, questionnaire_trends=questionnaire_trends)
+    return render(request, "contributor_results_trends.html", template_data)
+
+
 @editor_required
 def settings_edit(request):
     user = request.user
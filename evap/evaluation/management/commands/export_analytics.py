@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.models import Semester
+from evap.staff.exporters import export_analytics
+
+
+class Command(BaseCommand):
+    help = ('Writes the rating answer counters together with the metadata of their courses and questions as gzip '
+            'compressed CSV. The first two rows contain the names and types of the columns.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Name of the file the export is written to.')
+        parser.add_argument('--semester', type=int, action='append', dest='semesters', metavar='SEMESTER_ID',
+            help='Only export courses of this semester. Can be given multiple times. Defaults to all semesters.')
+
+    def handle(self, *args, **options):
+        semesters = Semester.objects.all()
+        if options['semesters']:
+            semesters = semesters.filter(id__in=options['semesters'])
+
+        with open(options['output'], 'wb') as output:
+            export_analytics(semesters, output)
+        self.stdout.write("Exported the answers of {} semesters to {}.".format(semesters.count(), options['output']))
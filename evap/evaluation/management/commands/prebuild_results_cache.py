@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.core.serializers.base import ProgressBar
+
+from evap.evaluation.models import Course
+from evap.results.tools import calculate_results_for_courses, get_results_cache_namespace
+
+
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Calculates the results of all published courses that are missing in the results cache namespace of the '
+            'current code and settings. Run this with a new version before switching over to it.')
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--semester', type=int, action='append', dest='semesters', metavar='SEMESTER_ID',
+            help='Only prebuild the results of courses of this semester. Can be given multiple times.')
+
+    def handle(self, *args, **options):
+        courses = Course.objects.filter(state='published')
+        if options['semesters']:
+            courses = courses.filter(semester_id__in=options['semesters'])
+        course_ids = list(courses.values_list('id', flat=True))
+
+        self.stdout.write("Prebuilding results cache namespace {} for {} courses...".format(get_results_cache_namespace(), len(course_ids)))
+
+        self.stdout.ending = None
+        progress_bar = ProgressBar(self.stdout, len(course_ids))
+        for i in range(0, len(course_ids), BATCH_SIZE):
+            batch = course_ids[i:i + BATCH_SIZE]
+            # results that are already in the namespace are read from the cache and not calculated again
+            calculate_results_for_courses(Course.objects.filter(id__in=batch))
+            progress_bar.update(i + len(batch))
+
+        self.stdout.write("Results cache namespace has been prebuilt.\n")
@@ -1,28 +1,75 @@
+from multiprocessing import Pool
+
 from django.core.management.base import BaseCommand
 from django.core.serializers.base import ProgressBar
 from django.core.cache import cache
+from django.db import connections
 
 from evap.evaluation.models import Course
-from evap.results.tools import calculate_results
+from evap.results.tools import calculate_results_for_courses, get_results_cache_namespace, get_saved_results_calculations_count
+
+
+# maps the ids of the refreshed courses to the (answer_data_version, last_modified_time) they were refreshed with
+REFRESHED_VERSIONS_CACHE_KEY = 'evap.evaluation.management.commands.refresh_results_cache.refreshed_versions-{}'
+BATCH_SIZE = 100
+
+
+def refresh_results(course_ids):
+    calculate_results_for_courses(Course.objects.filter(id__in=course_ids), force_recalculation=True)
+    return len(course_ids)
 
 
 class Command(BaseCommand):
     args = ''
-    help = 'Clears the cache and pre-warms it with the results of all courses'
+    help = 'Recalculates the cached results of all courses'
     requires_migrations_checks = True
 
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+            help='Only refresh courses whose answers or data changed since they were refreshed the last time.')
+        parser.add_argument('--semester', type=int, action='append', dest='semesters', metavar='SEMESTER_ID',
+            help='Only refresh courses of this semester. Can be given multiple times.')
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of processes calculating results in parallel.')
+
     def handle(self, *args, **options):
-        self.stdout.write("Clearing cache...")
-        cache.clear()
-        total_count = Course.objects.count()
+        courses = Course.objects.all()
+        if options['semesters']:
+            courses = courses.filter(semester_id__in=options['semesters'])
 
-        self.stdout.write("Calculating results for all courses...")
+        # the versions are read before calculating, so courses changing in the meantime get refreshed again in the next run
+        versions = {course_id: (answer_data_version, last_modified_time.timestamp())
+            for course_id, answer_data_version, last_modified_time in courses.values_list('id', 'answer_data_version', 'last_modified_time')}
+        refreshed_versions = cache.get(REFRESHED_VERSIONS_CACHE_KEY.format(get_results_cache_namespace()), {})
+        if options['incremental']:
+            course_ids = [course_id for course_id, version in versions.items() if refreshed_versions.get(course_id) != version]
+        else:
+            course_ids = list(versions.keys())
+
+        self.stdout.write("Calculating results for {} courses...".format(len(course_ids)))
 
         self.stdout.ending = None
-        progress_bar = ProgressBar(self.stdout, total_count)
+        progress_bar = ProgressBar(self.stdout, len(course_ids))
+        batches = [course_ids[i:i + BATCH_SIZE] for i in range(0, len(course_ids), BATCH_SIZE)]
+        if options['workers'] > 1:
+            # the worker processes must not share the database connections of this process
+            connections.close_all()
+            with Pool(options['workers']) as pool:
+                counts = pool.imap_unordered(refresh_results, batches)
+                self.update_progress(progress_bar, counts)
+        else:
+            self.update_progress(progress_bar, map(refresh_results, batches))
 
-        for counter, course in enumerate(Course.objects.all()):
-            progress_bar.update(counter + 1)
-            calculate_results(course)
+        refreshed_versions.update((course_id, versions[course_id]) for course_id in course_ids)
+        cache.set(REFRESHED_VERSIONS_CACHE_KEY.format(get_results_cache_namespace()), refreshed_versions, None)
 
         self.stdout.write("Results cache has been refreshed.\n")
+        self.stdout.write("Results calculations saved by waiting for other processes since the cache was cleared: {}\n".format(
+            get_saved_results_calculations_count()))
+
+    @staticmethod
+    def update_progress(progress_bar, counts):
+        done = 0
+        for count in counts:
+            done += count
+            progress_bar.update(done)
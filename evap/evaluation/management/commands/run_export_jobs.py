@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.models import ExportJob
+from evap.evaluation.management.commands.tools import log_exceptions
+from evap.staff.exporters import run_export_job
+
+logger = logging.getLogger(__name__)
+
+# finished jobs and their files are deleted after this time
+EXPORT_JOB_RETENTION = timedelta(days=7)
+
+
+@log_exceptions
+class Command(BaseCommand):
+    help = 'Runs all queued export jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep waiting for new jobs instead of exiting when the queue is empty.')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait before looking for new jobs again when using --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            ExportJob.objects.filter(finished_at__lt=datetime.now() - EXPORT_JOB_RETENTION).delete()
+
+            # jobs are fetched one at a time, so multiple workers can run in parallel
+            job = ExportJob.objects.filter(state=ExportJob.QUEUED).order_by('created_at').first()
+            if job:
+                if run_export_job(job):
+                    logger.info('Export job {} finished with state {}.'.format(job.id, job.state))
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,36 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.management.commands.tools import log_exceptions
+from evap.results.tools import get_courses_to_warm_up, get_saved_results_calculations_count, warm_up_results_cache
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+
+@log_exceptions
+class Command(BaseCommand):
+    args = ''
+    help = ('Calculates the results of all published courses whose grades are missing, e.g. because they were just published. '
+            'Run this regularly or with --loop, so the first visitors of new results don\'t have to wait for them.')
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep waiting for newly published courses instead of exiting when all are warmed up.')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait before looking for newly published courses again when using --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            # the queue is read once per round, so courses whose grades can't be stored are not retried in a busy loop
+            course_ids = list(get_courses_to_warm_up().values_list('id', flat=True))
+            for i in range(0, len(course_ids), BATCH_SIZE):
+                warm_up_results_cache(course_ids[i:i + BATCH_SIZE])
+            if course_ids:
+                logger.info('Warmed up the results of {} courses. Results calculations saved by waiting for other processes since the cache was cleared: {}'
+                    .format(len(course_ids), get_saved_results_calculations_count()))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
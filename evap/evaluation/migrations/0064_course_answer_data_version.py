@@ -0,0 +1,18 @@
+# Generated by Django 2.0.13 on 2026-10-16 22:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0063_add_heading_question_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='answer_data_version',
+            field=models.IntegerField(default=0, editable=False, verbose_name='answer data version'),
+        ),
+    ]
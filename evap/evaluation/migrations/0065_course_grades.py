@@ -0,0 +1,33 @@
+# Generated by Django 2.0.13 on 2026-10-16 22:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# the grades of existing courses can't be calculated with the historical models here, they are stored
+# by the warm_up_results_cache command, which deployment/update_production.sh runs after migrating.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0064_course_answer_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseGrades',
+            fields=[
+                ('course', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='grades', serialize=False, to='evaluation.Course', verbose_name='course')),
+                ('results_cache_namespace', models.CharField(max_length=64, verbose_name='results cache namespace')),
+                ('average', models.FloatField(null=True, verbose_name='average grade')),
+                ('deviation', models.FloatField(null=True, verbose_name='deviation')),
+                ('likert_average', models.FloatField(null=True, verbose_name='average of likert questions')),
+                ('likert_deviation', models.FloatField(null=True, verbose_name='deviation of likert questions')),
+                ('grade_average', models.FloatField(null=True, verbose_name='average of grade questions')),
+                ('grade_deviation', models.FloatField(null=True, verbose_name='deviation of grade questions')),
+            ],
+            options={
+                'verbose_name': 'course grades',
+                'verbose_name_plural': 'course grades',
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.0.13 on 2026-10-16 22:53
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import evap.evaluation.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0065_course_grades'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('export_type', models.CharField(choices=[('xls', 'results (.xls)'), ('xlsx', 'results (.xlsx)'), ('raw', 'raw course data'), ('participation', 'participation data')], max_length=16, verbose_name='export type')),
+                ('parameters', models.TextField(default='{}', verbose_name='parameters')),
+                ('language', models.CharField(max_length=8, verbose_name='language')),
+                ('data_version', models.CharField(max_length=255, verbose_name='data version')),
+                ('state', models.CharField(choices=[('QUEUED', 'queued'), ('RUNNING', 'running'), ('DONE', 'done'), ('FAILED', 'failed')], default='QUEUED', max_length=8, verbose_name='state')),
+                ('progress', models.IntegerField(default=0, verbose_name='progress in percent')),
+                ('file', models.FileField(blank=True, max_length=255, upload_to=evap.evaluation.models.helper_export_job_upload_path, verbose_name='file')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finished at')),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='export_job_requested_by+', to=settings.AUTH_USER_MODEL, verbose_name='requested by')),
+                ('semester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='export_jobs', to='evaluation.Semester', verbose_name='semester')),
+            ],
+            options={
+                'verbose_name': 'export job',
+                'verbose_name_plural': 'export jobs',
+                'ordering': ('-created_at',),
+            },
+        ),
+    ]
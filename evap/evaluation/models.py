@@ -1,5 +1,6 @@
 from datetime import datetime, date, timedelta
 import logging
+import os
 import random
 import uuid
 
@@ -10,7 +11,8 @@ from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage
 from django.db import models, transaction
-from django.db.models import Count, Q
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.signals import pre_delete
 from django.dispatch import Signal, receiver
 from django.template import Context, Template
 from django.template.base import TemplateSyntaxError
@@ -92,6 +94,15 @@ class Semester(models.Model, metaclass=LocalizeModelBase):
     def is_active_semester(self):
         return self == Semester.active_semester()
 
+    @property
+    def data_version(self):
+        """A string that changes whenever courses of this semester are added, removed or saved,
+        or their answers change. Used to find out whether earlier exports are still up to date."""
+        from evap.results.tools import get_results_cache_namespace
+        aggregate = self.course_set.aggregate(count=Count('id'), id_sum=Sum('id'), last_modified_time=Max('last_modified_time'),
+                                              answer_data_version=Sum('answer_data_version'))
+        return '{}-{count}-{id_sum}-{last_modified_time}-{answer_data_version}'.format(get_results_cache_namespace(), **aggregate)
+
 
 class Questionnaire(models.Model, metaclass=LocalizeModelBase):
     """A named collection of questions."""
@@ -241,6 +252,9 @@ class Course(models.Model, metaclass=LocalizeModelBase):
     last_modified_time = models.DateTimeField(auto_now=True)
     last_modified_user = models.ForeignKey(settings.AUTH_USER_MODEL, models.SET_NULL, null=True, blank=True, related_name="course_last_modified_user+")
 
+    # incremented whenever the answers of this course change, see bump_answer_data_version
+    answer_data_version = models.IntegerField(verbose_name=_("answer data version"), default=0, editable=False)
+
     course_evaluated = Signal(providing_args=['request', 'semester'])
 
     class Meta:
@@ -341,7 +355,11 @@ class Course(models.Model, metaclass=LocalizeModelBase):
         if self.is_single_result:
             return get_sum_of_answer_counters(self.ratinganswer_counters) > 0
 
-        return self.num_voters >= settings.MIN_ANSWER_COUNT and float(self.num_voters) / self.num_participants >= settings.MIN_ANSWER_PERCENTAGE
+        return self.has_enough_voters(self.num_voters, self.num_participants)
+
+    @staticmethod
+    def has_enough_voters(num_voters, num_participants):
+        return num_voters >= settings.MIN_ANSWER_COUNT and float(num_voters) / num_participants >= settings.MIN_ANSWER_PERCENTAGE
 
     @transition(field=state, source=['new', 'editor_approved'], target='prepared')
     def ready_for_editors(self):
@@ -391,6 +409,7 @@ class Course(models.Model, metaclass=LocalizeModelBase):
     def unpublish(self):
         from evap.results.tools import get_results_cache_key
         cache.delete(get_results_cache_key(self))
+        CourseGrades.objects.filter(course=self).delete()
 
     @property
     def student_state(self):
@@ -458,6 +477,19 @@ class Course(models.Model, metaclass=LocalizeModelBase):
             return True
         return False
 
+    @property
+    def data_version(self):
+        """A string that changes whenever the course is saved, e.g. when its state changes, or its answers
+        change, e.g. when votes arrive or text answers are reviewed."""
+        from evap.results.tools import get_results_cache_namespace
+        return '{}-{:d}-{}'.format(get_results_cache_namespace(), self.answer_data_version, self.last_modified_time.timestamp())
+
+    def bump_answer_data_version(self):
+        """Increments answer_data_version in the database. This locks the course until the
+        end of the current transaction, so concurrent changes of its answers are serialized."""
+        Course.objects.filter(pk=self.pk).update(answer_data_version=F('answer_data_version') + 1)
+        self.refresh_from_db(fields=['answer_data_version', 'last_modified_time'])
+
     @property
     def textanswer_set(self):
         """Pseudo relationship to all text answers for this course"""
@@ -524,6 +556,7 @@ class Course(models.Model, metaclass=LocalizeModelBase):
     def update_courses(cls):
         logger.info("update_courses called. Processing courses now.")
         from evap.evaluation.tools import send_publish_notifications
+        from evap.results.tools import warm_up_published_courses
 
         courses_new_in_evaluation = []
         evaluation_results_courses = []
@@ -549,6 +582,11 @@ class Course(models.Model, metaclass=LocalizeModelBase):
 
         template = EmailTemplate.objects.get(name=EmailTemplate.EVALUATION_STARTED)
         EmailTemplate.send_to_users_in_courses(template, courses_new_in_evaluation, [EmailTemplate.ALL_PARTICIPANTS], use_cc=False, request=None)
+        try:
+            warm_up_published_courses(evaluation_results_courses)
+        except Exception:
+            # the courses stay queued for the warm_up_results_cache command
+            logger.exception('An error occured when warming up the results of the published courses.')
         send_publish_notifications(evaluation_results_courses)
         logger.info("update_courses finished.")
 
@@ -562,6 +600,27 @@ def log_state_transition(sender, **kwargs):
     logger.info('Course "{}" (id {}) moved from state "{}" to state "{}", caused by transition "{}".'.format(course, course.id, source_state, target_state, transition_name))
 
 
+class CourseGrades(models.Model):
+    """The final grades of a published course, denormalized from its results so course lists can be
+    sorted and filtered by grade in the database. They are updated whenever the results of the course
+    are calculated, see evap.results.tools.update_course_grades."""
+
+    course = models.OneToOneField(Course, models.CASCADE, primary_key=True, related_name="grades", verbose_name=_("course"))
+    # the results cache namespace the grades were calculated in, they are outdated if it differs from the current one
+    results_cache_namespace = models.CharField(max_length=64, verbose_name=_("results cache namespace"))
+
+    average = models.FloatField(verbose_name=_("average grade"), null=True)
+    deviation = models.FloatField(verbose_name=_("deviation"), null=True)
+    likert_average = models.FloatField(verbose_name=_("average of likert questions"), null=True)
+    likert_deviation = models.FloatField(verbose_name=_("deviation of likert questions"), null=True)
+    grade_average = models.FloatField(verbose_name=_("average of grade questions"), null=True)
+    grade_deviation = models.FloatField(verbose_name=_("deviation of grade questions"), null=True)
+
+    class Meta:
+        verbose_name = _("course grades")
+        verbose_name_plural = _("course grades")
+
+
 class Contribution(models.Model):
     """A contributor who is assigned to a course and his questionnaires."""
 
@@ -1182,3 +1241,71 @@ class EmailTemplate(models.Model):
 
         cls.send_to_user(user, template, subject_params, body_params, use_cc=False)
         logger.info(('Sent login url to {}.').format(user.username))
+
+
+def helper_export_job_upload_path(instance, filename):
+    return "exports/{}/{}".format(instance.id, filename)
+
+
+class ExportJob(models.Model):
+    """An export of a semester that is created in the background by the run_export_jobs command."""
+
+    RESULTS_XLS = 'xls'
+    RESULTS_XLSX = 'xlsx'
+    RAW = 'raw'
+    PARTICIPATION = 'participation'
+    EXPORT_TYPES = (
+        (RESULTS_XLS, _('results (.xls)')),
+        (RESULTS_XLSX, _('results (.xlsx)')),
+        (RAW, _('raw course data')),
+        (PARTICIPATION, _('participation data')),
+    )
+
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    STATES = (
+        (QUEUED, _('queued')),
+        (RUNNING, _('running')),
+        (DONE, _('done')),
+        (FAILED, _('failed')),
+    )
+
+    semester = models.ForeignKey(Semester, models.CASCADE, related_name="export_jobs", verbose_name=_("semester"))
+    export_type = models.CharField(max_length=16, choices=EXPORT_TYPES, verbose_name=_("export type"))
+    # the options of the export as JSON with sorted keys, so equal options are stored equally
+    parameters = models.TextField(verbose_name=_("parameters"), default='{}')
+    language = models.CharField(max_length=8, verbose_name=_("language"))
+    # the version of the exported data when the job was queued, see evap.staff.exporters.get_export_data_version
+    data_version = models.CharField(max_length=255, verbose_name=_("data version"))
+
+    state = models.CharField(max_length=8, choices=STATES, default=QUEUED, verbose_name=_("state"))
+    progress = models.IntegerField(default=0, verbose_name=_("progress in percent"))
+    file = models.FileField(upload_to=helper_export_job_upload_path, max_length=255, blank=True, verbose_name=_("file"))
+
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, models.SET_NULL, null=True, blank=True, related_name="export_job_requested_by+", verbose_name=_("requested by"))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("created at"))
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name=_("finished at"))
+
+    class Meta:
+        ordering = ('-created_at',)
+        verbose_name = _("export job")
+        verbose_name_plural = _("export jobs")
+
+    def __str__(self):
+        return "{} ({})".format(self.get_export_type_display(), self.semester)
+
+    @property
+    def is_finished(self):
+        return self.state in [self.DONE, self.FAILED]
+
+    @property
+    def filename(self):
+        return os.path.basename(self.file.name)
+
+
+@receiver(pre_delete, sender=ExportJob)
+def delete_export_job_file(sender, instance, **kwargs):
+    if instance.file:
+        instance.file.delete(False)
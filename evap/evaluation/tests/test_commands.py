@@ -1,16 +1,23 @@
+import csv
 from datetime import datetime, date, timedelta
+import gzip
 from io import StringIO
 import os
+import tempfile
 from unittest.mock import patch
 
 from django.conf import settings
 from django.core import management, mail
+from django.core.cache import cache
+from django.db import transaction
 from django.test import TestCase
 from django.test.utils import override_settings
 
 from model_mommy import mommy
 
-from evap.evaluation.models import UserProfile, Course, Semester
+from evap.evaluation.models import UserProfile, Course, CourseGrades, Semester, RatingAnswerCounter, Questionnaire, Question
+from evap.results.tools import (SAVED_RESULTS_CALCULATIONS_CACHE_KEY, get_courses_to_warm_up, get_results_cache_key,
+                                get_unpublished_results_cache_key)
 
 
 class TestAnonymizeCommand(TestCase):
@@ -59,12 +66,121 @@ class TestReloadTestdataCommand(TestCase):
 
 
 class TestRefreshResultsCacheCommand(TestCase):
+    def refreshed_course_ids(self, *args):
+        with patch('evap.evaluation.management.commands.refresh_results_cache.calculate_results_for_courses') as mock:
+            management.call_command('refresh_results_cache', *args, stdout=StringIO())
+        return {course.id for call_args in mock.call_args_list for course in call_args[0][0]}
+
     def test_calls_calculate_results(self):
         mommy.make(Course)
-        with patch('evap.results.tools.calculate_results') as mock:
-            management.call_command('refresh_results_cache', stdout=StringIO())
+        self.assertEqual(self.refreshed_course_ids(), set(Course.objects.values_list('id', flat=True)))
+
+    def test_semester_filter(self):
+        course = mommy.make(Course)
+        mommy.make(Course)
+        self.assertEqual(self.refreshed_course_ids('--semester', str(course.semester.id)), {course.id})
+
+    def test_incremental(self):
+        course = mommy.make(Course)
+        changed_course = mommy.make(Course)
+        self.refreshed_course_ids()
+        self.assertEqual(self.refreshed_course_ids('--incremental'), set())
+
+        changed_course.bump_answer_data_version()
+        new_course = mommy.make(Course)
+        self.assertEqual(self.refreshed_course_ids('--incremental'), {changed_course.id, new_course.id})
+
+        course.save()
+        self.assertEqual(self.refreshed_course_ids('--incremental'), {course.id})
+
+    def test_reports_saved_results_calculations(self):
+        cache.set(SAVED_RESULTS_CALCULATIONS_CACHE_KEY, 3, None)
+        output = StringIO()
+        management.call_command('refresh_results_cache', stdout=output)
+        self.assertIn("Results calculations saved by waiting for other processes since the cache was cleared: 3", output.getvalue())
+
+
+class TestPrebuildResultsCacheCommand(TestCase):
+    def test_calculates_missing_results(self):
+        published_course = mommy.make(Course, state='published')
+        unpublished_course = mommy.make(Course, state='reviewed')
+        management.call_command('prebuild_results_cache', stdout=StringIO())
+
+        self.assertIsNotNone(cache.get(get_results_cache_key(published_course)))
+        self.assertIsNone(cache.get(get_unpublished_results_cache_key(unpublished_course)))
+
+        with patch('evap.results.tools._calculate_results_impl') as mock:
+            management.call_command('prebuild_results_cache', stdout=StringIO())
+        self.assertEqual(mock.call_count, 0)
+
+
+class TestWarmUpResultsCacheCommand(TestCase):
+    def test_calculates_results_of_published_courses(self):
+        course = mommy.make(Course, state='reviewed')
+        mommy.make(Course, state='reviewed')
+        course.publish()
+        course.save()
+        self.assertIsNone(cache.get(get_results_cache_key(course)))
+        self.assertEqual(list(get_courses_to_warm_up()), [course])
+
+        management.call_command('warm_up_results_cache')
+
+        self.assertIsNotNone(cache.get(get_results_cache_key(course)))
+        self.assertTrue(CourseGrades.objects.filter(course=course).exists())
+        self.assertFalse(get_courses_to_warm_up().exists())
+
+        with patch('evap.results.tools._calculate_results_impl') as mock:
+            management.call_command('warm_up_results_cache')
+        self.assertEqual(mock.call_count, 0)
+
+    def test_stores_grades_of_cached_results(self):
+        course = mommy.make(Course, state='published')
+        management.call_command('warm_up_results_cache')
+        CourseGrades.objects.all().delete()
+
+        with patch('evap.results.tools._calculate_results_impl') as mock:
+            management.call_command('warm_up_results_cache')
+        self.assertEqual(mock.call_count, 0)
+        self.assertTrue(CourseGrades.objects.filter(course=course).exists())
+
+    def test_backfills_grades_of_courses_published_before_they_were_stored(self):
+        question = mommy.make(Question, questionnaire=mommy.make(Questionnaire), type="G")
+        course = mommy.make(Course, state='published')
+        course.general_contribution.questionnaires.set([question.questionnaire])
+        mommy.make(RatingAnswerCounter, question=question, contribution=course.general_contribution, answer=2, count=3)
+        cache.clear()
+        self.assertFalse(CourseGrades.objects.exists())
+
+        management.call_command('warm_up_results_cache')
+
+        grades = CourseGrades.objects.get(course=course)
+        self.assertEqual((grades.average, grades.grade_average), (2, 2))
+
+    def test_rolled_back_publishing_is_not_queued(self):
+        course = mommy.make(Course, state='reviewed')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                course.publish()
+                course.save()
+                raise ValueError()
+
+        self.assertFalse(get_courses_to_warm_up().exists())
+
+
+class TestExportAnalyticsCommand(TestCase):
+    def test_exports_answers_of_selected_semesters(self):
+        semester = mommy.make(Semester)
+        mommy.make(RatingAnswerCounter, contribution__course__semester=semester, question__type="L", answer=1, count=2)
+        mommy.make(RatingAnswerCounter, question__type="L", answer=1, count=3)
+
+        with tempfile.NamedTemporaryFile(suffix=".csv.gz") as output:
+            management.call_command('export_analytics', output.name, '--semester', str(semester.id), stdout=StringIO())
+            with gzip.open(output.name, 'rt', encoding='utf-8', newline='') as exported_file:
+                rows = list(csv.reader(exported_file, delimiter=";"))
 
-        self.assertEqual(mock.call_count, Course.objects.count())
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[2][0], str(semester.id))
+        self.assertEqual(rows[2][rows[0].index("count")], "2")
 
 
 class TestUpdateCourseStatesCommand(TestCase):
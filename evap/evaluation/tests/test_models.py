@@ -8,9 +8,9 @@ from django.core import mail
 
 from model_mommy import mommy
 
-from evap.evaluation.models import (Contribution, Course, CourseType, EmailTemplate, NotArchiveable, Questionnaire,
+from evap.evaluation.models import (Contribution, Course, CourseGrades, CourseType, EmailTemplate, NotArchiveable, Questionnaire,
                                     RatingAnswerCounter, Semester, UserProfile)
-from evap.results.tools import calculate_average_grades_and_deviation
+from evap.results.tools import calculate_average_grades_and_deviation, get_results_cache_key
 from evap.settings import EVALUATION_END_OFFSET_HOURS, EVALUATION_END_WARNING_PERIOD
 
 
@@ -65,6 +65,19 @@ class TestCourses(TestCase):
         course = Course.objects.get(pk=course.pk)
         self.assertEqual(course.state, 'published')
 
+    def test_publishing_warms_up_results(self):
+        course = mommy.make(Course, state='in_evaluation', vote_start_datetime=datetime.now() - timedelta(days=2),
+                            vote_end_date=date.today() - timedelta(days=1),
+                            is_graded=False)
+        other_course = mommy.make(Course, state='published', semester=course.semester)
+        cache.clear()
+
+        with patch('evap.evaluation.tools.send_publish_notifications'):
+            Course.update_courses()
+
+        self.assertIsNotNone(cache.get(get_results_cache_key(Course.objects.get(pk=course.pk))))
+        self.assertEqual(set(CourseGrades.objects.values_list('course_id', flat=True)), {course.id, other_course.id})
+
     @override_settings(EVALUATION_END_WARNING_PERIOD=24)
     def test_evaluation_ends_soon(self):
         course = mommy.make(Course, state='in_evaluation', vote_start_datetime=datetime.now() - timedelta(days=2),
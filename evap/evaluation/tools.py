@@ -1,10 +1,13 @@
 from collections import OrderedDict, defaultdict
 import datetime
+import hashlib
 import operator
 
 from django.conf import settings
 from django.contrib.auth import user_logged_in
 from django.dispatch import receiver
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.utils.translation import ugettext_lazy as _
 from django.utils import translation
 from django.utils.translation import LANGUAGE_SESSION_KEY, get_language
@@ -136,6 +139,30 @@ def date_to_datetime(date):
     return datetime.datetime(year=date.year, month=date.month, day=date.day)
 
 
+def get_etag(*parts):
+    """Returns an entity tag for a response that only depends on the given parts."""
+    return hashlib.sha1("-".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def get_not_modified_response(request, etag, last_modified=None):
+    """Returns a 304 response if the client's copy of the response with the given validators is
+    still up to date and None otherwise. last_modified is a datetime."""
+    response = get_conditional_response(request, etag=quote_etag(etag), last_modified=last_modified and int(last_modified.timestamp()))
+    if response:
+        add_validators(response, etag, last_modified)
+    return response
+
+
+def add_validators(response, etag, last_modified=None):
+    """Adds the validators used by get_not_modified_response to the response. Clients are asked to
+    revalidate their copy on each use, so they never show outdated results."""
+    response['ETag'] = quote_etag(etag)
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 @receiver(user_logged_in)
 def set_or_get_language(sender, user, request, **kwargs):
     if user.language:
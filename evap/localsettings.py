@@ -0,0 +1 @@
+DATABASES = {'default': {'ENGINE': 'django.db.backends.postgresql', 'NAME': 'evap', 'USER': 'postgres', 'HOST': 'localhost'}}
@@ -1,11 +1,19 @@
-from collections import OrderedDict
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+from django.conf import settings
+from django.db import connections
+from django.db.models import Sum
+from django.utils import translation
 from django.utils.translation import ugettext as _
 
+import xlsxwriter
 import xlwt
 
-from evap.evaluation.models import CourseType
-from evap.results.tools import calculate_results, calculate_average_grades_and_deviation, get_grade_color, get_deviation_color, has_no_rating_answers
+from evap.evaluation.models import Contribution, Course, CourseType, Questionnaire, RatingAnswerCounter
+from evap.results.tools import (avg, calculate_average_grades_and_deviation_for_courses, calculate_average_grades_and_deviation_from_results,
+                                calculate_results_for_courses, calculate_statistics, get_approval_count, get_counts, get_deviation_color,
+                                get_grade_color, get_participant_and_voter_counts)
 
 
 class ExcelExporter(object):
@@ -94,41 +102,118 @@ class ExcelExporter(object):
 
         return filtered_questions
 
-    def export(self, response, course_types_list, include_not_enough_answers=False, include_unpublished=False):
+    @staticmethod
+    def aggregate_results(results):
+        """Combines the results of a question from several contributions into the average, the
+        deviation and the approval percentage weighted by the answer counts. Returns None if
+        there are no answers."""
+        values = []
+        deviations = []
+        total_count = 0
+        approval_count = 0
+        for result in results:
+            if result.average:
+                values.append(result.average * result.total_count)
+                deviations.append(result.deviation * result.total_count)
+                total_count += result.total_count
+            if result.question.is_yes_no_question:
+                approval_count += result.approval_count
+        if not values:
+            return None
+        return sum(values) / total_count, sum(deviations) / total_count, approval_count / total_count
+
+    def create_workbook(self, output):
         self.workbook = xlwt.Workbook()
         self.init_styles(self.workbook)
+
+    def add_sheet(self, name):
+        self.sheet = self.workbook.add_sheet(name)
+
+    def save(self, output):
+        self.workbook.save(output)
+
+    def gather_sheet_data(self, course_types, include_not_enough_answers, include_unpublished):
+        """Returns the courses of the given types together with their aggregated results, the used questionnaires,
+        a dict mapping their ids to the questions shown in the export and the names of the course types. This
+        doesn't touch the workbook or the questionnaires, so it can run in a worker thread."""
+        courses_with_results = list()
+        course_states = ['published']
+        if include_unpublished:
+            course_states.extend(['evaluated', 'reviewed'])
+
+        used_questionnaires = set()
+        courses = []
+        for course in self.semester.course_set.filter(state__in=course_states, type__in=course_types).all():
+            if course.is_single_result:
+                continue
+            if not course.can_publish_grades and not include_not_enough_answers:
+                continue
+            courses.append(course)
+
+        sections_by_course = calculate_results_for_courses(courses)
+        for course in courses:
+            # maps (questionnaire id, question id) to the results of all contributions with that questionnaire
+            results = defaultdict(list)
+            for questionnaire, __, __, data, __ in sections_by_course[course.id]:
+                if not any(result.total_count > 0 for result in data if result.question.is_rating_question):
+                    continue
+                for result in data:
+                    if result.question.is_rating_question:
+                        results[(questionnaire.id, result.question.id)].append(result)
+                used_questionnaires.add(questionnaire)
+            course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation_from_results(sections_by_course[course.id])
+            if not course.can_publish_grades:
+                results.clear()
+            courses_with_results.append((course, {key: self.aggregate_results(question_results) for key, question_results in results.items()}))
+
+        courses_with_results.sort(key=lambda cr: (cr[0].type, cr[0].name))
+        used_questionnaires = sorted(used_questionnaires)
+        # the questionnaires are shared with other threads, so the filtered questions are not stored in them
+        filtered_questions = {questionnaire.id: self.filter_text_and_heading_questions(questionnaire.question_set.all()) for questionnaire in used_questionnaires}
+
+        course_type_names = [ct.name for ct in CourseType.objects.filter(pk__in=course_types)]
+        return courses_with_results, used_questionnaires, filtered_questions, course_type_names
+
+    def gather_data(self, course_types_list, include_not_enough_answers, include_unpublished):
+        """Yields the data of each sheet in order. With more than one worker configured in EXPORT_SHEET_WORKERS,
+        the sheets are gathered in parallel threads, each using its own database connection."""
+        workers = min(settings.EXPORT_SHEET_WORKERS, len(course_types_list))
+        if workers <= 1:
+            for course_types in course_types_list:
+                yield self.gather_sheet_data(course_types, include_not_enough_answers, include_unpublished)
+            return
+
+        # the active language is local to the thread that activated it
+        language = translation.get_language()
+
+        def gather_sheet_data_in_thread(course_types):
+            try:
+                with translation.override(language):
+                    return self.gather_sheet_data(course_types, include_not_enough_answers, include_unpublished)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(workers) as executor:
+            yield from executor.map(gather_sheet_data_in_thread, course_types_list)
+
+    def headline(self, course_type_names):
+        return _("Evaluation {0}\n\n{1}").format(self.semester.name, ", ".join(course_type_names))
+
+    def export(self, output, course_types_list, include_not_enough_answers=False, include_unpublished=False, progress=None):
+        """Writes the export to output. If given, progress is called with the fraction of finished sheets after each sheet."""
+        self.create_workbook(output)
         counter = 1
 
-        for course_types in course_types_list:
-            self.sheet = self.workbook.add_sheet("Sheet " + str(counter))
+        sheets_data = self.gather_data(course_types_list, include_not_enough_answers, include_unpublished)
+        for courses_with_results, used_questionnaires, filtered_questions, course_type_names in sheets_data:
+            if progress and counter > 1:
+                progress((counter - 1) / len(course_types_list))
+            self.add_sheet("Sheet " + str(counter))
             counter += 1
             self.row = 0
             self.col = 0
 
-            courses_with_results = list()
-            course_states = ['published']
-            if include_unpublished:
-                course_states.extend(['evaluated', 'reviewed'])
-
-            used_questionnaires = set()
-            for course in self.semester.course_set.filter(state__in=course_states, type__in=course_types).all():
-                if course.is_single_result:
-                    continue
-                if not course.can_publish_grades and not include_not_enough_answers:
-                    continue
-                results = OrderedDict()
-                for questionnaire, contributor, __, data, __ in calculate_results(course):
-                    if has_no_rating_answers(course, contributor, questionnaire):
-                        continue
-                    results.setdefault(questionnaire.id, []).extend(data)
-                    used_questionnaires.add(questionnaire)
-                courses_with_results.append((course, results))
-
-            courses_with_results.sort(key=lambda cr: (cr[0].type, cr[0].name))
-            used_questionnaires = sorted(used_questionnaires)
-
-            course_type_names = [ct.name for ct in CourseType.objects.filter(pk__in=course_types)]
-            writec(self, _("Evaluation {0}\n\n{1}").format(self.semester.name, ", ".join(course_type_names)), "headline")
+            writec(self, self.headline(course_type_names), "headline")
 
             for course, results in courses_with_results:
                 writec(self, course.name, "course", cols=2)
@@ -143,53 +228,31 @@ class ExcelExporter(object):
                 for course, results in courses_with_results:
                     self.write_two_empty_cells_with_borders()
 
-                filtered_questions = self.filter_text_and_heading_questions(questionnaire.question_set.all())
-
-                for question in filtered_questions:
+                for question in filtered_questions[questionnaire.id]:
                     if question.is_heading_question:
                         writen(self, question.text, "italic")
                     else:
                         writen(self, question.text)
 
                     for course, results in courses_with_results:
-                        if questionnaire.id not in results or question.is_heading_question:
+                        aggregated_result = results.get((questionnaire.id, question.id))
+                        if aggregated_result is None:
                             self.write_two_empty_cells_with_borders()
                             continue
-                        qn_results = results[questionnaire.id]
-                        values = []
-                        deviations = []
-                        total_count = 0
-                        approval_count = 0
-
-                        for grade_result in qn_results:
-                            if grade_result.question.id == question.id:
-                                if grade_result.average:
-                                    values.append(grade_result.average * grade_result.total_count)
-                                    deviations.append(grade_result.deviation * grade_result.total_count)
-                                    total_count += grade_result.total_count
-                                if grade_result.question.is_yes_no_question:
-                                    approval_count += grade_result.approval_count
-                        enough_answers = course.can_publish_grades
-                        if values and enough_answers:
-                            avg = sum(values) / total_count
-                            dev = sum(deviations) / total_count
-
-                            if question.is_yes_no_question:
-                                percent_approval = float(approval_count) / float(total_count) if total_count > 0 else 0
-                                writec(self, "{:.0%}".format(percent_approval), self.grade_to_style(avg))
-                                writec(self, None, "border_right")
-                            else:
-                                writec(self, avg, self.grade_to_style(avg))
-                                writec(self, dev, self.deviation_to_style(dev))
+                        avg, dev, approval = aggregated_result
+                        if question.is_yes_no_question:
+                            writec(self, "{:.0%}".format(approval), self.grade_to_style(avg))
+                            writec(self, None, "border_right")
                         else:
-                            self.write_two_empty_cells_with_borders()
+                            writec(self, avg, self.grade_to_style(avg))
+                            writec(self, dev, self.deviation_to_style(dev))
                 writen(self, None)
                 for course, results in courses_with_results:
                     self.write_two_empty_cells_with_borders()
 
             writen(self, _("Overall Average Grade"), "bold")
             for course, results in courses_with_results:
-                avg, dev = calculate_average_grades_and_deviation(course)
+                avg = course.avg_grade
                 if avg:
                     writec(self, avg, self.grade_to_style(avg, total=True), cols=2)
                 else:
@@ -197,7 +260,7 @@ class ExcelExporter(object):
 
             writen(self, _("Overall Average Standard Deviation"), "bold")
             for course, results in courses_with_results:
-                avg, dev = calculate_average_grades_and_deviation(course)
+                dev = course.avg_deviation
                 if dev is not None:
                     writec(self, dev, self.deviation_to_style(dev, total=True), cols=2)
                 else:
@@ -208,13 +271,151 @@ class ExcelExporter(object):
                 percent_participants = float(course.num_voters) / float(course.num_participants) if course.num_participants > 0 else 0
                 writec(self, "{}/{} ({:.0%})".format(course.num_voters, course.num_participants, percent_participants), "total_voters", cols=2)
 
-        self.workbook.save(response)
+        self.save(output)
 
     def write_two_empty_cells_with_borders(self):
         writec(self, None, "border_left")
         writec(self, None, "border_right")
 
 
+class XlsxSheet:
+    """Provides the part of the xlwt sheet interface used by `_write` for an xlsxwriter worksheet."""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def write(self, row, col, label, style):
+        self.worksheet.write(row, col, label, style)
+
+    def write_merge(self, first_row, last_row, first_col, last_col, label, style):
+        self.worksheet.merge_range(first_row, first_col, last_row, last_col, label, style)
+
+
+class XlsxExporter(ExcelExporter):
+    """Writes the export as .xlsx file. Each row is flushed to a temporary file as soon as the
+    next one is started, so the memory usage does not depend on the size of the semester.
+    Grades and deviations are shown in their exact colour and there is no column limit."""
+
+    MEDIUM_BORDER = 2
+    FORMATS = {
+        'default':       {},
+        'avg':           {'align': 'center', 'bold': True, 'left': MEDIUM_BORDER, 'top': MEDIUM_BORDER, 'bottom': MEDIUM_BORDER},
+        'headline':      {'bold': True, 'font_size': 20, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True},
+        'course':        {'align': 'center', 'text_wrap': True, 'rotation': 90, 'left': MEDIUM_BORDER, 'top': MEDIUM_BORDER, 'right': MEDIUM_BORDER},
+        'total_voters':  {'align': 'center', 'left': MEDIUM_BORDER, 'bottom': MEDIUM_BORDER, 'right': MEDIUM_BORDER},
+        'bold':          {'bold': True},
+        'italic':        {'italic': True},
+        'border_left':   {'left': MEDIUM_BORDER},
+        'border_right':  {'right': MEDIUM_BORDER},
+        'border_top_bottom_right': {'top': MEDIUM_BORDER, 'bottom': MEDIUM_BORDER, 'right': MEDIUM_BORDER},
+    }
+    GRADE_FORMAT = {'pattern': 1, 'align': 'center', 'bold': True, 'left': MEDIUM_BORDER, 'num_format': '0.0'}
+    DEVIATION_FORMAT = {'pattern': 1, 'align': 'center', 'right': MEDIUM_BORDER, 'num_format': '0.0'}
+
+    def create_workbook(self, output):
+        self.workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        self.styles = {style_name: self.workbook.add_format(properties) for style_name, properties in self.FORMATS.items()}
+
+    def add_sheet(self, name):
+        self.sheet = XlsxSheet(self.workbook.add_worksheet(name))
+
+    def save(self, output):
+        self.workbook.close()
+
+    def color_style(self, prefix, color, properties):
+        """Returns the name of a style with the given properties and background colour and creates it if needed."""
+        style_name = '{}_#{:02x}{:02x}{:02x}'.format(prefix, *color)
+        if style_name not in self.styles:
+            self.styles[style_name] = self.workbook.add_format(dict(properties, bg_color=style_name[len(prefix) + 1:]))
+        return style_name
+
+    def grade_to_style(self, grade, total=False):
+        if total:
+            return self.color_style('grade_total', get_grade_color(grade), dict(self.GRADE_FORMAT, right=self.MEDIUM_BORDER))
+        return self.color_style('grade', get_grade_color(grade), self.GRADE_FORMAT)
+
+    def deviation_to_style(self, deviation, total=False):
+        if total:
+            return self.color_style('deviation_total', get_deviation_color(deviation), dict(self.DEVIATION_FORMAT, left=self.MEDIUM_BORDER))
+        return self.color_style('deviation', get_deviation_color(deviation), self.DEVIATION_FORMAT)
+
+
+# the columns of the comparison export. they provide the attributes of a course the export uses.
+SemesterColumn = namedtuple('SemesterColumn', ('name', 'avg_grade', 'avg_deviation', 'num_voters', 'num_participants'))
+
+
+class SemesterComparisonExporter(ExcelExporter):
+    """Writes the results of several semesters side by side, with one column per semester.
+    The results of the questions are pooled from all answers given in the semester's courses, which are
+    summed up by a few aggregation queries instead of calculating the results of each course. The overall
+    average grade and deviation of a semester are the averages of its courses' grades, so each course counts
+    the same, like in the export of a single semester."""
+
+    def __init__(self, semesters):
+        super().__init__(None)
+        self.semesters = sorted(semesters, key=lambda semester: (semester.created_at, semester.id))
+
+    def headline(self, course_type_names):
+        return _("Comparison of {0}\n\n{1}").format(", ".join(semester.name for semester in self.semesters), ", ".join(course_type_names))
+
+    def gather_sheet_data(self, course_types, include_not_enough_answers, include_unpublished):
+        course_states = ['published']
+        if include_unpublished:
+            course_states.extend(['evaluated', 'reviewed'])
+        single_result_contributions = Contribution.objects.filter(responsible=True, questionnaires__name_en=Questionnaire.SINGLE_RESULT_QUESTIONNAIRE_NAME)
+        courses = Course.objects.filter(semester__in=self.semesters, type__in=course_types, state__in=course_states).exclude(
+            id__in=single_result_contributions.values('course_id'))
+
+        course_counts = get_participant_and_voter_counts(courses)
+        if not include_not_enough_answers:
+            course_counts = {course_id: counts for course_id, counts in course_counts.items() if Course.has_enough_voters(counts[2], counts[1])}
+
+        # maps (semester id, question id) to the number of times each answer was given in the semester
+        answer_counts = defaultdict(lambda: [0] * 5)
+        answer_count_sums = RatingAnswerCounter.objects.filter(contribution__course_id__in=course_counts.keys()).values(
+            'contribution__course__semester_id', 'question_id', 'answer').annotate(count_sum=Sum('count')).order_by()
+        for answer_count_sum in answer_count_sums:
+            answer_counts[(answer_count_sum['contribution__course__semester_id'], answer_count_sum['question_id'])][answer_count_sum['answer'] - 1] += answer_count_sum['count_sum']
+
+        question_ids = {question_id for __, question_id in answer_counts.keys()}
+        used_questionnaires = sorted(Questionnaire.objects.filter(question__id__in=question_ids).distinct().prefetch_related('question_set'))
+
+        # the grades of published courses are read from their CourseGrades with a single query
+        average_grades_and_deviations = calculate_average_grades_and_deviation_for_courses(course for course in courses if course.id in course_counts)
+
+        columns_with_results = []
+        for semester in self.semesters:
+            results = dict()
+            for questionnaire in used_questionnaires:
+                for question in questionnaire.question_set.all():
+                    if (semester.id, question.id) not in answer_counts:
+                        continue
+                    counts = get_counts(question, answer_counts[(semester.id, question.id)])
+                    total_count, average, deviation = calculate_statistics(counts)
+                    if total_count == 0:
+                        continue
+                    approval = get_approval_count(question, counts) / total_count if question.is_yes_no_question else None
+                    results[(questionnaire.id, question.id)] = (average, deviation, approval)
+
+            semester_course_ids = [course_id for course_id, counts in course_counts.items() if counts[0] == semester.id]
+            column = SemesterColumn(
+                semester.name,
+                avg(average_grades_and_deviations[course_id][0] for course_id in semester_course_ids),
+                avg(average_grades_and_deviations[course_id][1] for course_id in semester_course_ids),
+                sum(course_counts[course_id][2] for course_id in semester_course_ids),
+                sum(course_counts[course_id][1] for course_id in semester_course_ids))
+            columns_with_results.append((column, results))
+
+        filtered_questions = {questionnaire.id: self.filter_text_and_heading_questions(questionnaire.question_set.all()) for questionnaire in used_questionnaires}
+
+        course_type_names = [ct.name for ct in CourseType.objects.filter(pk__in=course_types)]
+        return columns_with_results, used_questionnaires, filtered_questions, course_type_names
+
+
+class SemesterComparisonXlsxExporter(SemesterComparisonExporter, XlsxExporter):
+    pass
+
+
 def writen(exporter, label="", style_name="default"):
     """Write the cell at the beginning of the next row."""
     exporter.col = 0
@@ -5,7 +5,7 @@ from django.test import TestCase
 from django.utils import translation
 
 from evap.evaluation.models import Semester, Course, Contribution, UserProfile, Question, Questionnaire, RatingAnswerCounter, CourseType
-from evap.results.exporters import ExcelExporter
+from evap.results.exporters import ExcelExporter, SemesterComparisonExporter, SemesterComparisonXlsxExporter, XlsxExporter
 
 
 class TestExporters(TestCase):
@@ -79,3 +79,94 @@ class TestExporters(TestCase):
         self.assertEqual(workbook.sheets()[0].row_values(0)[1], "A - Course2")
         self.assertEqual(workbook.sheets()[0].row_values(0)[3], "B - Course1")
 
+    def test_results_of_contributions_are_combined(self):
+        students = mommy.make(UserProfile, _quantity=4)
+        course = mommy.make(Course, state='published', participants=students, voters=students)
+        questionnaire = mommy.make(Questionnaire)
+        likert_question = mommy.make(Question, type="L", questionnaire=questionnaire, order=0)
+        yes_no_question = mommy.make(Question, type="P", questionnaire=questionnaire, order=1)
+
+        for answer in [1, 3]:
+            contribution = mommy.make(Contribution, course=course, questionnaires=[questionnaire], contributor=mommy.make(UserProfile))
+            mommy.make(RatingAnswerCounter, question=likert_question, contribution=contribution, answer=answer, count=2)
+            mommy.make(RatingAnswerCounter, question=yes_no_question, contribution=contribution, answer=answer if answer == 1 else 5, count=2)
+
+        # a questionnaire without answers is not exported
+        empty_questionnaire = mommy.make(Questionnaire)
+        mommy.make(Question, type="L", questionnaire=empty_questionnaire)
+        mommy.make(Contribution, course=course, questionnaires=[empty_questionnaire], contributor=mommy.make(UserProfile))
+
+        for exporter_class in [ExcelExporter, XlsxExporter]:
+            binary_content = BytesIO()
+            exporter_class(course.semester).export(binary_content, [[course.type.id]])
+            binary_content.seek(0)
+            sheet = xlrd.open_workbook(file_contents=binary_content.read()).sheets()[0]
+
+            self.assertEqual(sheet.row_values(2)[0], questionnaire.name)
+            self.assertEqual(sheet.row_values(3)[0:3], [likert_question.text, 2.0, 0.0])
+            self.assertEqual(sheet.row_values(4)[0:2], [yes_no_question.text, "50%"])
+            self.assertNotIn(empty_questionnaire.name, sheet.col_values(0))
+
+    def test_semester_comparison(self):
+        course_type = mommy.make(CourseType)
+        questionnaire = mommy.make(Questionnaire)
+        likert_question = mommy.make(Question, type="L", questionnaire=questionnaire, order=0)
+        semesters = [mommy.make(Semester, name_en="Semester {}".format(i)) for i in range(2)]
+
+        for semester, answer in zip(semesters, [1, 3]):
+            students = mommy.make(UserProfile, _quantity=2)
+            course = mommy.make(Course, state='published', type=course_type, semester=semester, participants=students, voters=students)
+            contribution = mommy.make(Contribution, course=course, questionnaires=[questionnaire], contributor=None)
+            mommy.make(RatingAnswerCounter, question=likert_question, contribution=contribution, answer=answer, count=2)
+
+        # courses with too few voters are left out
+        students = mommy.make(UserProfile, _quantity=10)
+        course = mommy.make(Course, state='published', type=course_type, semester=semesters[0], participants=students, voters=students[:1])
+        contribution = mommy.make(Contribution, course=course, questionnaires=[questionnaire], contributor=None)
+        mommy.make(RatingAnswerCounter, question=likert_question, contribution=contribution, answer=5, count=1)
+
+        for exporter_class in [SemesterComparisonExporter, SemesterComparisonXlsxExporter]:
+            binary_content = BytesIO()
+            with translation.override("en"):
+                exporter_class(semesters).export(binary_content, [[course_type.id]])
+            binary_content.seek(0)
+            sheet = xlrd.open_workbook(file_contents=binary_content.read()).sheets()[0]
+
+            self.assertEqual(sheet.row_values(0)[1], "Semester 0")
+            self.assertEqual(sheet.row_values(0)[3], "Semester 1")
+            self.assertEqual(sheet.row_values(2)[0], questionnaire.name)
+            self.assertEqual(sheet.row_values(3)[0:5], [likert_question.text, 1.0, 0.0, 3.0, 0.0])
+            self.assertEqual(sheet.row_values(5)[0:2], ["Overall Average Grade", 1.0])
+            self.assertEqual(sheet.row_values(5)[3], 3.0)
+            self.assertEqual(sheet.row_values(7)[0:2], ["Total voters/Total participants", "2/2 (100%)"])
+
+    def test_semester_comparison_grades_match_semester_export(self):
+        course_type = mommy.make(CourseType)
+        semester = mommy.make(Semester)
+        general_questionnaire = mommy.make(Questionnaire, is_for_contributors=False)
+        contributor_questionnaire = mommy.make(Questionnaire, is_for_contributors=True)
+        likert_question = mommy.make(Question, type="L", questionnaire=general_questionnaire)
+        grade_question = mommy.make(Question, type="G", questionnaire=contributor_questionnaire)
+
+        # the courses get different numbers of answers, so pooling their answers would weight them differently
+        for answer, count in [(1, 2), (4, 10)]:
+            students = mommy.make(UserProfile, _quantity=count)
+            course = mommy.make(Course, state='published', type=course_type, semester=semester, participants=students, voters=students)
+            course.general_contribution.questionnaires.set([general_questionnaire])
+            contribution = mommy.make(Contribution, course=course, questionnaires=[contributor_questionnaire], contributor=mommy.make(UserProfile))
+            mommy.make(RatingAnswerCounter, question=likert_question, contribution=course.general_contribution, answer=answer, count=count)
+            mommy.make(RatingAnswerCounter, question=grade_question, contribution=contribution, answer=answer + 1, count=count)
+
+        def get_sheet(exporter):
+            binary_content = BytesIO()
+            with translation.override("en"):
+                exporter.export(binary_content, [[course_type.id]])
+            binary_content.seek(0)
+            return xlrd.open_workbook(file_contents=binary_content.read()).sheets()[0]
+
+        semester_sheet = get_sheet(ExcelExporter(semester))
+        comparison_sheet = get_sheet(SemesterComparisonExporter([semester]))
+
+        semester_row = semester_sheet.row_values(semester_sheet.col_values(0).index("Overall Average Grade"))
+        comparison_row = comparison_sheet.row_values(comparison_sheet.col_values(0).index("Overall Average Grade"))
+        self.assertAlmostEqual(comparison_row[1], (semester_row[1] + semester_row[3]) / 2)
@@ -1,4 +1,7 @@
 
+from statistics import pstdev
+from unittest.mock import patch
+
 from django.test.testcases import TestCase
 from django.core.cache import cache
 from django.conf import settings
@@ -6,8 +9,11 @@ from django.test import override_settings
 
 from model_mommy import mommy
 
-from evap.evaluation.models import Contribution, RatingAnswerCounter, Questionnaire, Question, Course, UserProfile
-from evap.results.tools import get_answers, get_answers_from_answer_counters, get_results_cache_key, calculate_average_grades_and_deviation, calculate_results
+from evap.evaluation.models import Contribution, RatingAnswerCounter, Questionnaire, Question, Course, CourseGrades, Semester, UserProfile, TextAnswer
+from evap.results.tools import get_answers, get_answers_from_answer_counters, get_results_cache_key, get_unpublished_results_cache_key, get_results_lock_key, calculate_average_grades_and_deviation, calculate_results, \
+    calculate_statistics, calculate_results_for_courses, calculate_average_grades_and_deviation_for_courses, YesNoResult, \
+    get_saved_results_calculations_count, calculate_average_grades_and_deviation_from_results, get_contributor_trends, _calculate_results_impl, \
+    RESULTS_WAIT_TIMEOUT
 from evap.staff.tools import merge_users
 
 
@@ -28,6 +34,203 @@ class TestCalculateResults(TestCase):
 
         self.assertIsNone(cache.get(get_results_cache_key(course)))
 
+    def test_calculate_results_for_courses(self):
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, questionnaire=questionnaire, type="G")
+        courses = mommy.make(Course, state='published', _quantity=3)
+        for answer, course in enumerate(courses, start=1):
+            contribution = mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[questionnaire])
+            mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=answer, count=2)
+        unpublished_course = mommy.make(Course, state='evaluated')
+        all_courses = courses + [unpublished_course]
+
+        calculate_results(courses[0])
+
+        results = calculate_results_for_courses(all_courses)
+
+        self.assertEqual(set(results.keys()), {course.id for course in all_courses})
+        for answer, course in enumerate(courses, start=1):
+            self.assertEqual(results[course.id][0].results[0].average, answer)
+            self.assertIsNotNone(cache.get(get_results_cache_key(course)))
+        self.assertEqual(results[unpublished_course.id], [])
+        self.assertIsNone(cache.get(get_results_cache_key(unpublished_course)))
+
+        with patch('evap.results.tools._calculate_results_impl') as mock:
+            calculate_results_for_courses(courses)
+        self.assertEqual(mock.call_count, 0)
+
+        averages = calculate_average_grades_and_deviation_for_courses(all_courses)
+        self.assertEqual(averages[courses[1].id], calculate_average_grades_and_deviation(courses[1]))
+        self.assertEqual(averages[unpublished_course.id], (None, None))
+
+    # the database cache needs a query per key for get_many and set_many, so the number of queries
+    # only doesn't depend on the number of courses with a cache that doesn't use the database.
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_number_of_queries_does_not_depend_on_number_of_courses(self):
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, questionnaire=questionnaire, type="G")
+
+        courses = mommy.make(Course, state='published', _quantity=10)
+        for course in courses:
+            contribution = mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[questionnaire])
+            mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=1, count=2)
+
+        # the questionnaire registry loads the questionnaires only once
+        calculate_results(courses[0])
+
+        with self.assertNumQueries(9):
+            calculate_results_for_courses(courses[1:4])
+        with self.assertNumQueries(9):
+            calculate_results_for_courses(courses[4:10])
+
+    def test_unpublished_results_are_cached_per_answer_data_version(self):
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, questionnaire=questionnaire, type="G")
+        course = mommy.make(Course, state='evaluated')
+        contribution = mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[questionnaire])
+        mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=1, count=2)
+
+        self.assertEqual(calculate_results(course)[0].results[0].average, 1)
+        self.assertIsNotNone(cache.get(get_unpublished_results_cache_key(course)))
+
+        with patch('evap.results.tools._calculate_results_impl') as mock:
+            calculate_results(course)
+        self.assertEqual(mock.call_count, 0)
+
+        mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=3, count=2)
+        course.bump_answer_data_version()
+        self.assertEqual(calculate_results(course)[0].results[0].average, 2)
+
+    def test_waits_for_results_calculated_by_other_process(self):
+        course = mommy.make(Course, state='published')
+        mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[mommy.make(Questionnaire)])
+        cache_key = get_results_cache_key(course)
+        compact_results = _calculate_results_impl([course])[course.id]
+        saved_calculations = get_saved_results_calculations_count()
+
+        # another process holds the lock and stores the results while this one is waiting
+        cache.add(get_results_lock_key(cache_key), True)
+        with patch('evap.results.tools.time.sleep', side_effect=lambda seconds: cache.set(cache_key, compact_results)):
+            with patch('evap.results.tools._calculate_results_impl') as mock:
+                results = calculate_results(course)
+        self.assertEqual(mock.call_count, 0)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(get_saved_results_calculations_count(), saved_calculations + 1)
+
+    def test_calculates_results_if_other_process_failed(self):
+        course = mommy.make(Course, state='published')
+        mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[mommy.make(Questionnaire)])
+        lock_key = get_results_lock_key(get_results_cache_key(course))
+
+        # another process holds the lock but releases it without storing results
+        cache.add(lock_key, True)
+        with patch('evap.results.tools.time.sleep', side_effect=lambda seconds: cache.delete(lock_key)):
+            results = calculate_results(course)
+        self.assertEqual(len(results), 1)
+        self.assertIsNotNone(cache.get(get_results_cache_key(course)))
+        self.assertIsNone(cache.get(lock_key))
+
+    def test_calculates_results_if_other_process_takes_too_long(self):
+        course = mommy.make(Course, state='published')
+        mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[mommy.make(Questionnaire)])
+        lock_key = get_results_lock_key(get_results_cache_key(course))
+
+        # another process holds the lock and doesn't finish in time
+        cache.add(lock_key, True)
+        with patch('evap.results.tools.time.monotonic', side_effect=[0, 0, RESULTS_WAIT_TIMEOUT]):
+            results = calculate_results(course)
+        self.assertEqual(len(results), 1)
+        self.assertIsNotNone(cache.get(get_results_cache_key(course)))
+
+    def test_no_locks_are_taken_for_several_courses(self):
+        courses = mommy.make(Course, state='published', _quantity=2)
+        lock_key = get_results_lock_key(get_results_cache_key(courses[0]))
+
+        # another process holds the lock of one of the courses, but batches don't wait for it
+        cache.add(lock_key, True)
+        with patch('evap.results.tools.time.sleep') as mock:
+            results = calculate_results_for_courses(courses)
+        self.assertEqual(mock.call_count, 0)
+        self.assertEqual(set(results.keys()), {course.id for course in courses})
+
+    def test_cache_key_depends_on_relevant_settings(self):
+        course = mommy.make(Course, state='published')
+        cache_key = get_results_cache_key(course)
+        with override_settings(CONTRIBUTION_PERCENTAGE=0.3):
+            self.assertNotEqual(get_results_cache_key(course), cache_key)
+        with override_settings(RESULTS_WARNING_COUNT=100):
+            self.assertNotEqual(get_results_cache_key(course), cache_key)
+        with override_settings(MIN_ANSWER_PERCENTAGE=0.9):
+            self.assertEqual(get_results_cache_key(course), cache_key)
+        with patch('evap.results.tools.RESULTS_CACHE_FORMAT_VERSION', 2):
+            self.assertNotEqual(get_results_cache_key(course), cache_key)
+
+    def test_course_grades_are_stored_with_results(self):
+        questionnaire = mommy.make(Questionnaire)
+        likert_question = mommy.make(Question, questionnaire=questionnaire, type="L")
+        grade_question = mommy.make(Question, questionnaire=questionnaire, type="G")
+        course = mommy.make(Course, state='reviewed')
+        contribution = course.general_contribution
+        contribution.questionnaires.set([questionnaire])
+        mommy.make(RatingAnswerCounter, question=likert_question, contribution=contribution, answer=1, count=2)
+        mommy.make(RatingAnswerCounter, question=grade_question, contribution=contribution, answer=3, count=2)
+
+        calculate_results(course)
+        self.assertFalse(CourseGrades.objects.filter(course=course).exists())
+
+        course.publish()
+        course.save()
+        calculate_results(course)
+        grades = CourseGrades.objects.get(course=course)
+        self.assertEqual((grades.average, grades.deviation), calculate_average_grades_and_deviation_from_results(calculate_results(course)))
+        self.assertEqual((grades.likert_average, grades.grade_average), (1, 3))
+        self.assertEqual(list(Course.objects.filter(grades__average__lt=3)), [course])
+
+        mommy.make(RatingAnswerCounter, question=grade_question, contribution=contribution, answer=5, count=2)
+        calculate_results(course, force_recalculation=True)
+        self.assertEqual(CourseGrades.objects.get(course=course).grade_average, 4)
+
+        with patch('evap.results.tools.calculate_results_for_courses') as mock:
+            average_grades_and_deviations = calculate_average_grades_and_deviation_for_courses([course])
+        self.assertEqual(mock.call_count, 0)
+        self.assertEqual(average_grades_and_deviations[course.id][0], CourseGrades.objects.get(course=course).average)
+
+        course.unpublish()
+        course.save()
+        self.assertFalse(CourseGrades.objects.filter(course=course).exists())
+
+    def test_cached_results_are_not_shared(self):
+        course = mommy.make(Course, state='published')
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, questionnaire=questionnaire, type="T")
+        contribution = mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[questionnaire])
+        mommy.make(TextAnswer, question=question, contribution=contribution, original_answer="published", state=TextAnswer.PUBLISHED)
+        mommy.make(TextAnswer, question=question, contribution=contribution, original_answer="hidden", state=TextAnswer.HIDDEN)
+
+        calculate_results(course)
+        results = calculate_results(course)
+
+        self.assertIsNot(results, calculate_results(course))
+        self.assertIsInstance(results[0].results, tuple)
+        self.assertEqual([answer.answer for answer in results[0].results[0].answers], ["published"])
+
+        # text answers are part of the cached data, so rendering them does not need any queries
+        with self.assertNumQueries(0):
+            self.assertTrue(all(answer.is_published for answer in results[0].results[0].answers))
+
+    def test_questionnaire_changes_are_visible_in_cached_results(self):
+        course = mommy.make(Course, state='published')
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, questionnaire=questionnaire, type="G", text_en="old text")
+        mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[questionnaire])
+
+        self.assertEqual(calculate_results(course)[0].results[0].question.text_en, "old text")
+
+        question.text_en = "new text"
+        question.save()
+
+        self.assertEqual(calculate_results(course)[0].results[0].question.text_en, "new text")
+
     def test_calculation_results(self):
         contributor1 = mommy.make(UserProfile)
         student = mommy.make(UserProfile)
@@ -53,6 +256,29 @@ class TestCalculateResults(TestCase):
         self.assertAlmostEqual(result.average, float(109) / 30)
         self.assertAlmostEqual(result.deviation, 1.015983376941878)
 
+    def test_number_of_queries_does_not_depend_on_course_size(self):
+        def make_course(num_contributors, num_questions):
+            course = mommy.make(Course, state='evaluated')
+            questionnaire = mommy.make(Questionnaire)
+            questions = mommy.make(Question, questionnaire=questionnaire, type="G", _quantity=num_questions)
+            mommy.make(Question, questionnaire=questionnaire, type="T")
+            for __ in range(num_contributors):
+                contribution = mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[questionnaire])
+                for question in questions:
+                    mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=2, count=3)
+            return course
+
+        small_course = make_course(num_contributors=1, num_questions=1)
+        large_course = make_course(num_contributors=5, num_questions=10)
+
+        with self.assertNumQueries(20):
+            calculate_results(small_course)
+        with self.assertNumQueries(20):
+            results = calculate_results(large_course)
+
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result.total_count == 3 for section in results for result in section.results if result.question.is_rating_question))
+
     def test_calculate_results_after_user_merge(self):
         """ Asserts that merge_users leaves the results cache in a consistent state. Regression test for #907 """
         contributor = mommy.make(UserProfile)
@@ -103,6 +329,37 @@ class TestCalculateResults(TestCase):
         answers = get_answers_from_answer_counters(answer_counters)
         self.assertListEqual(answers, [1, 3, 3, 3, 3, 4, 4, 5, 5, 5])
 
+    def test_statistics_match_expanded_answers(self):
+        for counts in [{1: 5, 2: 15, 3: 40, 4: 60, 5: 30}, {1: 1, 3: 4, 4: 2, 5: 3}, {2: 7}, {1: 1234, 5: 4321}]:
+            answers = [answer for answer, count in counts.items() for __ in range(count)]
+            total_count, average, deviation = calculate_statistics(counts)
+
+            self.assertEqual(total_count, len(answers))
+            self.assertAlmostEqual(average, sum(answers) / len(answers))
+            self.assertAlmostEqual(deviation, pstdev(answers))
+
+        self.assertEqual(calculate_statistics({1: 0, 2: 0, 3: 0, 4: 0, 5: 0}), (0, None, None))
+
+    def test_yes_no_results(self):
+        course = mommy.make(Course, state='published')
+        questionnaire = mommy.make(Questionnaire)
+        positive_question = mommy.make(Question, questionnaire=questionnaire, type="P", order=1)
+        negative_question = mommy.make(Question, questionnaire=questionnaire, type="N", order=2)
+        contribution = mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[questionnaire])
+        for question in [positive_question, negative_question]:
+            mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=1, count=3)
+            mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=5, count=1)
+
+        positive_result, negative_result = calculate_results(course)[0].results
+
+        self.assertIsInstance(positive_result, YesNoResult)
+        self.assertEqual(positive_result.total_count, 4)
+        self.assertEqual(list(positive_result.counts.items()), [(1, 3), (5, 1)])
+        self.assertAlmostEqual(positive_result.average, 2)
+        self.assertAlmostEqual(positive_result.deviation, pstdev([1, 1, 1, 5]))
+        self.assertEqual(positive_result.approval_count, 3)
+        self.assertEqual(negative_result.approval_count, 1)
+
     @override_settings(CONTRIBUTION_PERCENTAGE=0.3, GRADE_PERCENTAGE=0.6)
     def test_average_grades(self):
         contributor1 = mommy.make(UserProfile)
@@ -158,3 +415,51 @@ class TestCalculateResults(TestCase):
         total_dev = settings.GRADE_PERCENTAGE * total_grade_dev + (1 - settings.GRADE_PERCENTAGE) * total_likert_dev
 
         self.assertAlmostEqual(deviation, total_dev)
+
+
+class TestContributorTrends(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.contributor = mommy.make(UserProfile)
+        cls.questionnaire = mommy.make(Questionnaire, is_for_contributors=True)
+        cls.question = mommy.make(Question, questionnaire=cls.questionnaire, type="G")
+        cls.semesters = [mommy.make(Semester), mommy.make(Semester)]
+
+    def make_course(self, semester, state, answer, count):
+        course = mommy.make(Course, semester=semester, state=state, _participant_count=count, _voter_count=count)
+        contribution = mommy.make(Contribution, course=course, contributor=self.contributor, questionnaires=[self.questionnaire])
+        mommy.make(RatingAnswerCounter, question=self.question, contribution=contribution, answer=answer, count=count)
+        return course
+
+    def test_averages_per_semester(self):
+        self.make_course(self.semesters[1], 'published', answer=1, count=3)
+        self.make_course(self.semesters[0], 'published', answer=2, count=3)
+        self.make_course(self.semesters[0], 'published', answer=4, count=3)
+        self.make_course(self.semesters[0], 'published', answer=5, count=1)  # not enough voters
+        self.make_course(self.semesters[1], 'evaluated', answer=5, count=3)
+
+        semesters, questionnaire_trends = get_contributor_trends(self.contributor)
+
+        self.assertEqual(semesters, self.semesters)
+        self.assertEqual(len(questionnaire_trends), 1)
+        self.assertEqual(questionnaire_trends[0].questionnaire, self.questionnaire)
+        self.assertEqual(questionnaire_trends[0].semester_averages, [3, 1])
+        self.assertAlmostEqual(questionnaire_trends[0].total_average, 7 / 3)
+        question_trend = questionnaire_trends[0].question_trends[0]
+        self.assertEqual([result.average for result in question_trend.semester_results], [3, 1])
+        self.assertEqual(question_trend.total_result.total_count, 9)
+
+    def test_cached_answer_counts_are_deleted_on_publish(self):
+        course = self.make_course(self.semesters[0], 'reviewed', answer=2, count=3)
+        self.assertEqual(get_contributor_trends(self.contributor), ([], []))
+
+        course.publish()
+        course.save()
+
+        semesters, questionnaire_trends = get_contributor_trends(self.contributor)
+        self.assertEqual(questionnaire_trends[0].total_average, 2)
+
+        course.unpublish()
+        course.save()
+
+        self.assertEqual(get_contributor_trends(self.contributor), ([], []))
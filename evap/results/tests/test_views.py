@@ -1,8 +1,14 @@
+from unittest.mock import patch
+
 from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from model_mommy import mommy
 
-from evap.evaluation.models import Semester, UserProfile, Course, Contribution, Questionnaire, Degree, Question, RatingAnswerCounter
-from evap.evaluation.tests.tools import ViewTest
+from evap.evaluation.models import Semester, UserProfile, Course, Contribution, Questionnaire, Degree, Question, RatingAnswerCounter, TextAnswer
+from evap.evaluation.tests.tools import FuzzyInt, ViewTest
+from evap.results.tools import calculate_results
 
 
 class TestResultsView(ViewTest):
@@ -24,6 +30,27 @@ class TestResultsSemesterDetailView(ViewTest):
 
         cls.semester = mommy.make(Semester, id=1)
 
+    def test_not_modified_until_courses_change(self):
+        course = mommy.make(Course, state='published', semester=self.semester)
+        response = self.app.get(self.url, user='evap')
+
+        self.app.get(self.url, user='evap', headers={'If-None-Match': response.headers['ETag']}, status=304)
+
+        course.save()
+        self.app.get(self.url, user='evap', headers={'If-None-Match': response.headers['ETag']}, status=200)
+
+    def test_number_of_queries_does_not_depend_on_number_of_courses(self):
+        degree = mommy.make(Degree)
+        student = mommy.make(UserProfile)
+        for __ in range(20):
+            course = mommy.make(Course, state='published', semester=self.semester, degrees=[degree], participants=[student], voters=[student])
+            mommy.make(Contribution, course=course, contributor=mommy.make(UserProfile), responsible=True, can_edit=True, comment_visibility=Contribution.ALL_COMMENTS)
+
+        # the first request stores the grades of the courses and fills the session and the navbar cache
+        self.app.get(self.url, user='evap')
+        with self.assertNumQueries(FuzzyInt(0, 20)):
+            self.app.get(self.url, user='evap')
+
 
 class TestResultsSemesterCourseDetailView(ViewTest):
     url = '/results/semester/2/course/21'
@@ -71,6 +98,58 @@ class TestResultsSemesterCourseDetailView(ViewTest):
         self.assertIn(likert_question.text, page)
         self.assertNotIn(heading_question_2.text, page)
 
+    def test_number_of_queries_does_not_depend_on_number_of_text_answers(self):
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, type="T", questionnaire=questionnaire)
+        contribution = mommy.make(Contribution, course=self.course, questionnaires=[questionnaire], contributor=mommy.make(UserProfile))
+        self.course.general_contribution.questionnaires.add(questionnaire)
+
+        def get_number_of_queries():
+            # the results are calculated and rendered for every request
+            cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                self.app.get("/results/semester/2/course/21", user="contributor")
+            return len(context)
+
+        # the first request fills the session
+        self.app.get("/results/semester/2/course/21", user="contributor")
+        numbers_of_queries = []
+        for __ in range(2):
+            for answer_contribution in [contribution, self.course.general_contribution]:
+                mommy.make(TextAnswer, question=question, contribution=answer_contribution, state=TextAnswer.PUBLISHED, _quantity=20)
+            numbers_of_queries.append(get_number_of_queries())
+
+        self.assertEqual(numbers_of_queries[0], numbers_of_queries[1])
+
+    def test_not_modified_until_answers_change(self):
+        response = self.app.get("/results/semester/2/course/21", user="contributor")
+        etag = response.headers['ETag']
+
+        self.app.get("/results/semester/2/course/21", user="contributor", headers={'If-None-Match': etag}, status=304)
+        self.app.get("/results/semester/2/course/21", user="responsible", headers={'If-None-Match': etag}, status=200)
+
+        self.course.bump_answer_data_version()
+        self.app.get("/results/semester/2/course/21", user="contributor", headers={'If-None-Match': etag}, status=200)
+
+    def test_rendered_results_are_cached_for_shared_visibility_classes(self):
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, type="T", questionnaire=questionnaire)
+        contribution = Contribution.objects.get(course=self.course, contributor__username="contributor")
+        contribution.questionnaires.add(questionnaire)
+        mommy.make(TextAnswer, question=question, contribution=contribution, state=TextAnswer.PRIVATE, original_answer="private answer")
+
+        self.app.get("/results/semester/2/course/21", user="evap")
+        with patch('evap.results.views.calculate_results', wraps=calculate_results) as mock:
+            self.app.get("/results/semester/2/course/21", user="evap")
+            self.assertEqual(mock.call_count, 0)
+
+            # the results of contributors are not cached
+            self.assertIn("private answer", self.app.get("/results/semester/2/course/21", user="contributor"))
+            self.assertIn("private answer", self.app.get("/results/semester/2/course/21", user="contributor"))
+            self.assertEqual(mock.call_count, 2)
+
+        self.assertNotIn("private answer", self.app.get("/results/semester/2/course/21", user="responsible"))
+
     def test_single_result_course(self):
         url = '/results/semester/%s/course/%s' % (self.semester.id, self.single_result_course.id)
         user = 'evap'
@@ -1,14 +1,19 @@
 from collections import namedtuple, defaultdict, OrderedDict
-from functools import partial
-from math import ceil
-from statistics import pstdev, median
+from math import ceil, sqrt
+from statistics import median
+import hashlib
+import time
+import uuid
 
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Sum
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django_fsm.signals import post_transition
 
-from evap.evaluation.models import TextAnswer, Contribution, RatingAnswerCounter
-from evap.evaluation.tools import questionnaires_and_contributions
+from evap.evaluation.models import TextAnswer, Contribution, Course, CourseGrades, RatingAnswerCounter, Questionnaire, Question, Semester, UserProfile
 
 
 GRADE_COLORS = {
@@ -55,14 +60,6 @@ def get_answers(contribution, question):
     return question.answer_class.objects.filter(contribution=contribution, question=question)
 
 
-def get_number_of_answers(contribution, question):
-    answers = get_answers(contribution, question)
-    if question.is_rating_question:
-        return get_sum_of_answer_counters(answers)
-    else:
-        return len(answers)
-
-
 def get_sum_of_answer_counters(answer_counters):
     return answer_counters.aggregate(total_count=Sum('count'))['total_count'] or 0
 
@@ -83,96 +80,484 @@ def get_textanswers(contribution, question, filter_states=None):
     return answers
 
 
-def get_counts(question, answer_counters):
-    counts = OrderedDict()
-
+def get_counts(question, answer_counts):
+    """Returns an ordered {answer: count} mapping of the possible answers of the
+    given question. `answer_counts` contains the counts of the answers 1 to 5."""
     possible_answers = range(1, 6)
     if question.is_yes_no_question:
         possible_answers = [1, 5]
 
-    # ensure ordering of answers
-    for answer in possible_answers:
-        counts[answer] = 0
+    return OrderedDict((answer, answer_counts[answer - 1]) for answer in possible_answers)
 
-    for answer_counter in answer_counters:
-        counts[answer_counter.answer] = answer_counter.count
-    return counts
+
+def calculate_statistics(counts):
+    """Returns the total count, the average and the population standard deviation
+    of the answers described by the given {answer: count} mapping. The values are
+    calculated from the sums of the counts directly instead of expanding the counts
+    into one list item per vote. Average and deviation are `None` if there are no answers."""
+    total_count = sum(counts.values())
+    if total_count == 0:
+        return 0, None, None
+
+    answer_sum = sum(answer * count for answer, count in counts.items())
+    square_sum = sum(answer * answer * count for answer, count in counts.items())
+
+    average = answer_sum / total_count
+    # all sums are integers, so the variance's numerator is exact and can't become negative
+    deviation = sqrt(total_count * square_sum - answer_sum * answer_sum) / total_count
+    return total_count, average, deviation
+
+
+def get_approval_count(question, counts):
+    assert question.is_yes_no_question
+    if question.is_positive_yes_no_question:
+        return counts[1]
+    return counts[5]
+
+
+def create_rating_result(question, counts, warning_threshold):
+    total_count, average, deviation = calculate_statistics(counts)
+    warning = total_count > 0 and total_count < warning_threshold
+
+    if question.is_yes_no_question:
+        return YesNoResult(question, total_count, average, deviation, counts, warning, get_approval_count(question, counts))
+    return RatingResult(question, total_count, average, deviation, counts, warning)
+
+
+# results of unpublished courses are cached per answer_data_version. they expire quickly because
+# changes of contributions and questionnaire assignments do not increment the version.
+UNPUBLISHED_RESULTS_CACHE_TIMEOUT = 10 * 60
+
+# a process calculating results holds a lock for this long at most. other processes wait
+# for the results much shorter than the web server's timeout and then calculate them themselves.
+RESULTS_LOCK_TIMEOUT = 60
+RESULTS_WAIT_TIMEOUT = 5
+RESULTS_LOCK_POLL_INTERVAL = 0.1
+SAVED_RESULTS_CALCULATIONS_CACHE_KEY = 'evap.results.tools.saved_results_calculations'
+
+
+# increment this whenever the format of the cached data changes
+RESULTS_CACHE_FORMAT_VERSION = 1
+RESULTS_CACHE_RELEVANT_SETTINGS = ('CONTRIBUTION_PERCENTAGE', 'GRADE_PERCENTAGE', 'RESULTS_WARNING_PERCENTAGE', 'RESULTS_WARNING_COUNT')
+
+
+def get_results_cache_namespace():
+    """Returns a string identifying the format version and the settings the cached results
+    depend on. It is part of all cache keys, so after changing either of them, the old
+    entries are not read anymore and the results get recalculated on demand."""
+    relevant_settings = tuple(getattr(settings, name) for name in RESULTS_CACHE_RELEVANT_SETTINGS)
+    fingerprint = hashlib.sha1(repr(relevant_settings).encode()).hexdigest()[:10]
+    return '{:d}-{}'.format(RESULTS_CACHE_FORMAT_VERSION, fingerprint)
 
 
 def get_results_cache_key(course):
-    return 'evap.staff.results.tools.calculate_results-{:d}'.format(course.id)
+    return 'evap.results.tools.calculate_results-{}-{:d}'.format(get_results_cache_namespace(), course.id)
 
 
-def calculate_results(course, force_recalculation=False):
-    if course.state != "published":
-        return _calculate_results_impl(course)
+def get_unpublished_results_cache_key(course):
+    return 'evap.results.tools.calculate_results-{}-{:d}-{:d}-{}'.format(
+        get_results_cache_namespace(), course.id, course.answer_data_version, course.last_modified_time.timestamp())
+
+
+def get_results_lock_key(results_cache_key):
+    return results_cache_key + '-lock'
+
+
+# the answer counts of a course are kept for this long after their last change
+ANSWER_COUNTS_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def get_answer_counts_cache_key(course_id, answer_data_version, last_modified_time):
+    # the modification time is part of the key because saving a course object that was loaded before
+    # a vote happened resets its answer_data_version, which would make an outdated entry valid again.
+    return 'evap.results.tools.answer_counts-{}-{:d}-{:d}-{}'.format(get_results_cache_namespace(), course_id, answer_data_version, last_modified_time.timestamp())
+
 
-    cache_key = get_results_cache_key(course)
-    if force_recalculation:
-        cache.delete(cache_key)
-    return cache.get_or_set(cache_key, partial(_calculate_results_impl, course), None)
+def get_answer_counts(courses, force_reload=False):
+    """Returns a dict mapping the ids of the given courses to dicts mapping (contribution_id, question_id)
+    to a tuple of the counts of the answers 1 to 5. The counts are kept in the cache per version of the
+    courses' answers and are updated by `add_votes_to_answer_counts` when new votes arrive.
+    With force_reload, all counts are loaded from the database."""
+    cache_keys = {get_answer_counts_cache_key(course.id, course.answer_data_version, course.last_modified_time): course for course in courses}
+    answer_counts = {}
+    if not force_reload:
+        answer_counts = {cache_keys[cache_key].id: counts for cache_key, counts in cache.get_many(cache_keys.keys()).items()}
 
+    missing_courses = [course for course in courses if course.id not in answer_counts]
+    if missing_courses:
+        answer_counts.update(load_answer_counts(missing_courses))
+        cache.set_many({cache_key: answer_counts[course.id] for cache_key, course in cache_keys.items() if course in missing_courses}, ANSWER_COUNTS_CACHE_TIMEOUT)
 
-def _calculate_results_impl(course):
-    """Calculates the result data for a single course. Returns a list of
-    `ResultSection` tuples. Each of those tuples contains the questionnaire, the
-    contributor (or None), a list of single result elements, the average grade and
-    deviation for that section (or None). The result elements are either
-    `RatingResult` or `TextResult` instances."""
+    return answer_counts
 
-    # there will be one section per relevant questionnaire--contributor pair
+
+def load_answer_counts(courses):
+    """Loads the answer counts of the given courses from the database, see `get_answer_counts`."""
+    counts = {course.id: {} for course in courses}
+    for course_id, contribution_id, question_id, answer, count in (RatingAnswerCounter.objects.filter(contribution__course__in=courses)
+            .values_list('contribution__course_id', 'contribution_id', 'question_id', 'answer', 'count')):
+        counts[course_id].setdefault((contribution_id, question_id), [0] * 5)[answer - 1] = count
+    return {course_id: {key: tuple(question_counts) for key, question_counts in course_counts.items()} for course_id, course_counts in counts.items()}
+
+
+def add_votes_to_answer_counts(course, votes):
+    """Adds the given (contribution_id, question_id, answer) votes to the cached answer counts
+    of the course. Must be called inside the transaction that saved the votes, after calling
+    `course.bump_answer_data_version`. The cache is updated when the transaction is committed,
+    so rolled back votes leave no entries behind, and the counts of the previous version are
+    removed from it. If they are not cached, nothing is done and the counts will be loaded from
+    the database on the next request."""
+    previous_cache_key = get_answer_counts_cache_key(course.id, course.answer_data_version - 1, course.last_modified_time)
+    cache_key = get_answer_counts_cache_key(course.id, course.answer_data_version, course.last_modified_time)
+    votes = list(votes)
+
+    def update_answer_counts():
+        answer_counts = cache.get(previous_cache_key)
+        if answer_counts is None:
+            return
+
+        for contribution_id, question_id, answer in votes:
+            counts = list(answer_counts.get((contribution_id, question_id), (0, ) * 5))
+            counts[answer - 1] += 1
+            answer_counts[(contribution_id, question_id)] = tuple(counts)
+
+        cache.set(cache_key, answer_counts, ANSWER_COUNTS_CACHE_TIMEOUT)
+        cache.delete(previous_cache_key)
+
+    transaction.on_commit(update_answer_counts)
+
+
+class QuestionnaireRegistry:
+    """Per-process registry of questionnaires with prefetched questions, used to turn
+    the questionnaire ids stored in the results cache back into objects. The registry is
+    cleared in all processes whenever a questionnaire or question is changed. The objects
+    are shared between requests and must not be modified."""
+
+    VERSION_CACHE_KEY = 'evap.results.tools.QuestionnaireRegistry.version'
+
+    def __init__(self):
+        self.version = None
+        self.questionnaires = {}
+
+    def get_questionnaires(self, questionnaire_ids):
+        version = cache.get(self.VERSION_CACHE_KEY)
+        if version is None:
+            # the version got lost, so the registry might be stale even if nothing changed in this process
+            cache.add(self.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+            version = cache.get(self.VERSION_CACHE_KEY)
+        if version is None or version != self.version:
+            self.version = version
+            self.questionnaires = {}
+
+        questionnaires = self.questionnaires
+        missing_ids = set(questionnaire_ids) - questionnaires.keys()
+        if missing_ids:
+            questionnaires.update((questionnaire.id, questionnaire) for questionnaire in Questionnaire.objects.filter(id__in=missing_ids).prefetch_related('question_set'))
+        return questionnaires
+
+    @classmethod
+    def invalidate(cls):
+        cache.set(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+
+questionnaire_registry = QuestionnaireRegistry()
+
+
+@receiver([post_save, post_delete], sender=Questionnaire)
+@receiver([post_save, post_delete], sender=Question)
+def invalidate_questionnaire_registry(sender, **kwargs):
+    QuestionnaireRegistry.invalidate()
+
+
+def calculate_results(course, force_recalculation=False):
+    return calculate_results_for_courses([course], force_recalculation)[course.id]
+
+
+def calculate_results_for_courses(courses, force_recalculation=False):
+    """Returns a dict mapping the ids of the given courses to their results (see
+    `_build_sections`). The results are read from the cache with a single request.
+    Published courses are cached until they get unpublished, unpublished courses are cached
+    per answer_data_version for a short time only. All missing results are calculated
+    together, so the number of queries does not depend on the number of courses. This is not
+    true for the cache requests: the database cache needs a query per key for get_many and set_many.
+
+    Every call returns new result objects, so callers can't change the cached data."""
+    courses = list(courses)
+    published_cache_keys = {get_results_cache_key(course): course for course in courses if course.state == "published"}
+    unpublished_cache_keys = {get_unpublished_results_cache_key(course): course for course in courses if course.state != "published"}
+    cache_keys = dict(published_cache_keys)
+    cache_keys.update(unpublished_cache_keys)
+
+    results = {}
+    if not force_recalculation:
+        for cache_key, compact_results in cache.get_many(cache_keys.keys()).items():
+            results[cache_keys[cache_key].id] = compact_results
+
+    # when many users open the results page of a newly published course at the same time, only one process
+    # calculates the results and the others wait for them. batches are calculated by commands and pages
+    # listing courses, which don't take locks. with force_recalculation, there's nothing to wait for.
+    acquired_locks = []
+    if not force_recalculation and len(courses) == 1 and published_cache_keys and not results:
+        cache_key, course = next(iter(published_cache_keys.items()))
+        if cache.add(get_results_lock_key(cache_key), True, RESULTS_LOCK_TIMEOUT):
+            acquired_locks.append(get_results_lock_key(cache_key))
+        else:
+            compact_results = _wait_for_results(cache_key)
+            if compact_results is not None:
+                results[course.id] = compact_results
+
+    calculated_results = {}
+    try:
+        missing_courses = [course for course in courses if course.id not in results]
+        if missing_courses:
+            calculated_results = _calculate_results_impl(missing_courses, force_recalculation)
+            cache.set_many({cache_key: calculated_results[course.id] for cache_key, course in published_cache_keys.items() if course.id in calculated_results}, None)
+            cache.set_many({cache_key: calculated_results[course.id] for cache_key, course in unpublished_cache_keys.items() if course.id in calculated_results},
+                           UNPUBLISHED_RESULTS_CACHE_TIMEOUT)
+            results.update(calculated_results)
+    finally:
+        cache.delete_many(acquired_locks)
+
+    sections = _build_sections_for_courses(results)
+    update_course_grades({course.id: sections[course.id] for course in published_cache_keys.values() if course.id in calculated_results})
+    return sections
+
+
+def calculate_uncached_results_for_courses(courses):
+    """Calculates the results of the given courses like `calculate_results_for_courses`, but
+    neither reads nor writes any cache entries. The database cache needs a query per key,
+    so pages showing many courses use this for the few results they need."""
+    return _build_sections_for_courses(_calculate_results_impl(list(courses), use_cache=False))
+
+
+def _wait_for_results(cache_key):
+    """Waits until the results with the given cache key were calculated by the process
+    holding their lock and returns the compact results. Returns None if the lock was released
+    without storing them or if they are still missing after RESULTS_WAIT_TIMEOUT."""
+    deadline = time.monotonic() + RESULTS_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(RESULTS_LOCK_POLL_INTERVAL)
+        compact_results = cache.get(cache_key)
+        if compact_results is not None:
+            cache.add(SAVED_RESULTS_CALCULATIONS_CACHE_KEY, 0, None)
+            cache.incr(SAVED_RESULTS_CALCULATIONS_CACHE_KEY)
+            return compact_results
+        if cache.get(get_results_lock_key(cache_key)) is None:
+            return None
+    return None
+
+
+def get_saved_results_calculations_count():
+    """Returns how often a process got results calculated by another process
+    instead of calculating them itself."""
+    return cache.get(SAVED_RESULTS_CALCULATIONS_CACHE_KEY, 0)
+
+
+def get_courses_to_warm_up():
+    """Returns the published courses whose grades are missing in the current results cache namespace,
+    e.g. because they were just published. This is the queue drained by the warm_up_results_cache
+    command. It is part of the database, so publishing a course only enqueues it once the transaction
+    is committed, and unpublishing removes it again."""
+    return Course.objects.filter(state='published').exclude(grades__results_cache_namespace=get_results_cache_namespace())
+
+
+def warm_up_results_cache(course_ids):
+    """Calculates the results of the given courses and stores their grades, so the first visitors
+    of the results pages don't have to wait for them."""
+    results = calculate_results_for_courses(Course.objects.filter(id__in=course_ids))
+    # calculate_results_for_courses only stores the grades of results it didn't find in the cache
+    update_course_grades({course.id: results[course.id] for course in get_courses_to_warm_up().filter(id__in=course_ids)})
+
+
+def warm_up_published_courses(courses):
+    """Warms up the results of the given courses, which must have been published and saved, and the
+    grades of the other courses of their semesters that are still missing, so the visitors following
+    the publish notifications find the results pages and the semester pages warm."""
+    semester_ids = {course.semester_id for course in courses}
+    course_ids = {course.id for course in courses}
+    course_ids.update(get_courses_to_warm_up().filter(semester_id__in=semester_ids).values_list('id', flat=True))
+    if course_ids:
+        warm_up_results_cache(course_ids)
+
+
+def _calculate_results_impl(courses, force_recalculation=False, use_cache=True):
+    """Calculates the compact result data for the given courses and returns a dict
+    mapping the course ids to it. All data is loaded upfront, so the number of queries
+    neither depends on the number of courses nor on their contributions and questions.
+    With force_recalculation, the cached answer counts are not used. Without use_cache,
+    the answer counts are neither read from nor written to the cache.
+
+    The compact result data only consists of ids, numbers and strings:
+        - a tuple of (questionnaire_id, contribution_id, contributor_id, label) tuples,
+          one per section, with the sections of the general contribution first
+        - a dict mapping (contribution_id, question_id) to a tuple of the counts of the answers 1 to 5
+        - a dict mapping (contribution_id, question_id) to a tuple of
+          (id, original_answer, reviewed_answer, state) tuples of the visible text answers
+    """
+    contributions = Contribution.objects.filter(course__in=courses).values_list('id', 'course_id', 'contributor_id', 'label')
+    contribution_questionnaires = defaultdict(list)
+    through_model = Contribution.questionnaires.through
+    for contribution_id, questionnaire_id in (through_model.objects.filter(contribution__course__in=courses)
+            .order_by(*('questionnaire__' + field for field in Questionnaire._meta.ordering))
+            .values_list('contribution_id', 'questionnaire_id')):
+        contribution_questionnaires[contribution_id].append(questionnaire_id)
+
+    sections = {course.id: [] for course in courses}
+    for contribution_id, course_id, contributor_id, label in contributions:
+        for questionnaire_id in contribution_questionnaires[contribution_id]:
+            sections[course_id].append((questionnaire_id, contribution_id, contributor_id, label))
+
+    if use_cache:
+        answer_counts = get_answer_counts(courses, force_reload=force_recalculation)
+    else:
+        answer_counts = load_answer_counts(courses)
+
+    text_answers = defaultdict(lambda: defaultdict(list))
+    for course_id, contribution_id, question_id, *text_answer in (TextAnswer.objects
+            .filter(contribution__course__in=courses, state__in=COMMENT_STATES_REQUIRED_FOR_VISIBILITY)
+            .values_list('contribution__course_id', 'contribution_id', 'question_id', 'id', 'original_answer', 'reviewed_answer', 'state')):
+        text_answers[course_id][(contribution_id, question_id)].append(tuple(text_answer))
+
+    return {
+        course_id: (
+            # sort questionnaires for general contributions first
+            tuple(sorted(course_sections, key=lambda section: section[2] is not None)),
+            answer_counts[course_id],
+            {key: tuple(answers) for key, answers in text_answers[course_id].items()},
+        )
+        for course_id, course_sections in sections.items()
+    }
+
+
+def _build_sections_for_courses(compact_results_by_course):
+    """Turns the compact result data of several courses into result sections. The
+    questionnaires are taken from the registry and all contributors are loaded with
+    a single query."""
+    questionnaire_ids = set()
+    contributor_ids = set()
+    for sections, __, __ in compact_results_by_course.values():
+        for questionnaire_id, __, contributor_id, __ in sections:
+            questionnaire_ids.add(questionnaire_id)
+            contributor_ids.add(contributor_id)
+    contributor_ids.discard(None)
+
+    questionnaires = questionnaire_registry.get_questionnaires(questionnaire_ids)
+    contributors = UserProfile.objects.in_bulk(contributor_ids) if contributor_ids else {}
+
+    return {
+        course_id: _build_sections(compact_results, questionnaires, contributors)
+        for course_id, compact_results in compact_results_by_course.items()
+    }
+
+
+def _build_sections(compact_results, questionnaires, contributors):
+    """Builds the results of a single course from its compact result data. Returns a
+    list of `ResultSection` tuples. Each of those tuples contains the questionnaire, the
+    contributor (or None), the label, a tuple of single result elements and whether
+    a warning should be shown for the section. The result elements are `RatingResult`,
+    `YesNoResult`, `TextResult` or `HeadingResult` instances."""
+    section_data, answer_counts, text_answers = compact_results
+    section_data = [(questionnaires[questionnaire_id], contribution_id, contributor_id, label) for questionnaire_id, contribution_id, contributor_id, label in section_data]
+    no_answers = (0, ) * 5
+
+    counts = {}
+    for questionnaire, contribution_id, __, __ in section_data:
+        for question in questionnaire.rating_questions:
+            counts[(contribution_id, question.id)] = get_counts(question, answer_counts.get((contribution_id, question.id), no_answers))
+
+    # there will be one section per relevant questionnaire--contribution pair
     sections = []
 
     # calculate the median values of how many people answered a questionnaire type (lecturer, tutor, ...)
     questionnaire_med_answers = defaultdict(list)
     questionnaire_max_answers = {}
     questionnaire_warning_thresholds = {}
-    for questionnaire, contribution in questionnaires_and_contributions(course):
-        max_answers = max([get_number_of_answers(contribution, question) for question in questionnaire.rating_questions], default=0)
-        questionnaire_max_answers[(questionnaire, contribution)] = max_answers
+    for questionnaire, contribution_id, __, __ in section_data:
+        max_answers = max([sum(counts[(contribution_id, question.id)].values()) for question in questionnaire.rating_questions], default=0)
+        questionnaire_max_answers[(questionnaire, contribution_id)] = max_answers
         questionnaire_med_answers[questionnaire].append(max_answers)
     for questionnaire, max_answers in questionnaire_med_answers.items():
         questionnaire_warning_thresholds[questionnaire] = max(settings.RESULTS_WARNING_PERCENTAGE * median(max_answers), settings.RESULTS_WARNING_COUNT)
 
-    for questionnaire, contribution in questionnaires_and_contributions(course):
+    for questionnaire, contribution_id, contributor_id, label in section_data:
         # will contain one object per question
         results = []
         for question in questionnaire.question_set.all():
             if question.is_rating_question:
-                answer_counters = get_answers(contribution, question)
-                answers = get_answers_from_answer_counters(answer_counters)
-
-                total_count = len(answers)
-                average = avg(answers) if total_count > 0 else None
-                deviation = pstdev(answers, average) if total_count > 0 else None
-                counts = get_counts(question, answer_counters)
-                warning = total_count > 0 and total_count < questionnaire_warning_thresholds[questionnaire]
-
-                if question.is_yes_no_question:
-                    if question.is_positive_yes_no_question:
-                        approval_count = counts[1]
-                    else:
-                        approval_count = counts[5]
-                    results.append(YesNoResult(question, total_count, average, deviation, counts, warning, approval_count))
-                else:
-                    results.append(RatingResult(question, total_count, average, deviation, counts, warning))
+                results.append(create_rating_result(question, counts[(contribution_id, question.id)], questionnaire_warning_thresholds[questionnaire]))
 
             elif question.is_text_question:
-                answers = get_textanswers(contribution, question, COMMENT_STATES_REQUIRED_FOR_VISIBILITY)
+                answers = tuple(
+                    TextAnswer(id=answer_id, contribution_id=contribution_id, question_id=question.id, original_answer=original_answer, reviewed_answer=reviewed_answer, state=state)
+                    for answer_id, original_answer, reviewed_answer, state in text_answers.get((contribution_id, question.id), ())
+                )
                 results.append(TextResult(question=question, answers=answers))
 
             elif question.is_heading_question:
                 results.append(HeadingResult(question=question))
 
-        section_warning = questionnaire_max_answers[(questionnaire, contribution)] < questionnaire_warning_thresholds[questionnaire]
+        section_warning = questionnaire_max_answers[(questionnaire, contribution_id)] < questionnaire_warning_thresholds[questionnaire]
 
-        sections.append(ResultSection(questionnaire, contribution.contributor, contribution.label, results, section_warning))
+        sections.append(ResultSection(questionnaire, contributors.get(contributor_id), label, tuple(results), section_warning))
 
     return sections
 
 
+GradeSummary = namedtuple('GradeSummary', ('average', 'deviation', 'likert_average', 'likert_deviation', 'grade_average', 'grade_deviation'))
+
+
 def calculate_average_grades_and_deviation(course):
     """Determines the final average grade and deviation for a course."""
+    return calculate_average_grades_and_deviation_for_courses([course])[course.id]
+
+
+def calculate_average_grades_and_deviation_for_courses(courses):
+    """Returns a dict mapping the ids of the given courses to their final average
+    grade and deviation. The grades of published courses are read from their CourseGrades with
+    a single query. All others are calculated from their results without using the results cache,
+    see `calculate_uncached_results_for_courses`, and the missing CourseGrades get stored."""
+    courses = list(courses)
+    average_grades_and_deviations = {
+        course_id: (average, deviation) for course_id, average, deviation in CourseGrades.objects.filter(
+            course__in=[course for course in courses if course.state == 'published'], results_cache_namespace=get_results_cache_namespace()
+        ).values_list('course_id', 'average', 'deviation')
+    }
+
+    missing_courses = [course for course in courses if course.id not in average_grades_and_deviations]
+    if missing_courses:
+        results = calculate_uncached_results_for_courses(missing_courses)
+        average_grades_and_deviations.update((course_id, calculate_average_grades_and_deviation_from_results(sections)) for course_id, sections in results.items())
+        update_course_grades({course.id: results[course.id] for course in missing_courses if course.state == 'published'})
+    return average_grades_and_deviations
+
+
+def update_course_grades(results):
+    """Replaces the CourseGrades of the courses with the given results, a dict
+    mapping course ids to their result sections, with newly calculated ones."""
+    if not results:
+        return
+    namespace = get_results_cache_namespace()
+    course_grades = [
+        CourseGrades(course_id=course_id, results_cache_namespace=namespace, **calculate_grade_summary_from_results(sections)._asdict())
+        for course_id, sections in results.items()
+    ]
+    try:
+        with transaction.atomic():
+            CourseGrades.objects.filter(course_id__in=results.keys()).delete()
+            CourseGrades.objects.bulk_create(course_grades)
+    except IntegrityError:
+        pass  # another process stored the grades of the same results in the meantime
+
+
+def calculate_average_grades_and_deviation_from_results(sections):
+    """Determines the final average grade and deviation from the results of a course."""
+    grade_summary = calculate_grade_summary_from_results(sections)
+    return grade_summary.average, grade_summary.deviation
+
+
+def calculate_grade_summary_from_results(sections):
+    """Determines the final average grade and deviation from the results of a course together
+    with the averages and deviations of its likert and grade questions."""
     avg_generic_likert = []
     avg_contribution_likert = []
     dev_generic_likert = []
@@ -182,7 +567,7 @@ def calculate_average_grades_and_deviation(course):
     dev_generic_grade = []
     dev_contribution_grade = []
 
-    for __, contributor, __, results, __ in calculate_results(course):
+    for __, contributor, __, results, __ in sections:
         average_likert = avg([result.average for result in results if result.question.is_likert_question])
         deviation_likert = avg([result.deviation for result in results if result.question.is_likert_question])
         average_grade = avg([result.average for result in results if result.question.is_grade_question])
@@ -206,13 +591,121 @@ def calculate_average_grades_and_deviation(course):
     final_avg = mix(final_grade_avg, final_likert_avg, settings.GRADE_PERCENTAGE)
     final_dev = mix(final_grade_dev, final_likert_dev, settings.GRADE_PERCENTAGE)
 
-    return final_avg, final_dev
-
-
-def has_no_rating_answers(course, contributor, questionnaire):
-    questions = questionnaire.rating_questions
-    contribution = Contribution.objects.get(course=course, contributor=contributor)
-    return RatingAnswerCounter.objects.filter(question__in=questions, contribution=contribution).count() == 0
+    return GradeSummary(final_avg, final_dev, final_likert_avg, final_likert_dev, final_grade_avg, final_grade_dev)
+
+
+def get_participant_and_voter_counts(courses):
+    """Returns a {course id: (semester id, number of participants, number of voters)} mapping.
+    The numbers of courses that didn't store their counts yet are counted in a single query."""
+    course_counts = {}
+    uncounted_course_ids = []
+    for course_id, semester_id, participant_count, voter_count in courses.values_list('id', 'semester_id', '_participant_count', '_voter_count'):
+        course_counts[course_id] = (semester_id, participant_count, voter_count)
+        if participant_count is None:
+            uncounted_course_ids.append(course_id)
+
+    counted_courses = (Course.objects.filter(id__in=uncounted_course_ids)
+        .annotate(num_participants=Count('participants', distinct=True), num_voters=Count('voters', distinct=True))
+        .values_list('id', 'semester_id', 'num_participants', 'num_voters'))
+    for course_id, semester_id, participant_count, voter_count in counted_courses:
+        course_counts[course_id] = (semester_id, participant_count, voter_count)
+    return course_counts
+
+
+# publishing and unpublishing courses deletes the cached answer counts of their contributors, this is a safety net
+CONTRIBUTOR_ANSWER_COUNTS_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_contributor_answer_counts_cache_key(contributor_id):
+    return 'evap.results.tools.contributor_answer_counts-{}-{:d}'.format(get_results_cache_namespace(), contributor_id)
+
+
+def get_contributor_answer_counts(contributor):
+    """Returns a dict mapping (semester_id, question_id) to a tuple of the counts of the answers 1 to 5
+    given about the contributor in their published courses with enough voters. The counts of all
+    semesters are summed up in a single aggregation query and cached per contributor."""
+    cache_key = get_contributor_answer_counts_cache_key(contributor.id)
+    answer_counts = cache.get(cache_key)
+    if answer_counts is not None:
+        return answer_counts
+
+    single_result_contributions = Contribution.objects.filter(responsible=True, questionnaires__name_en=Questionnaire.SINGLE_RESULT_QUESTIONNAIRE_NAME)
+    courses = (Course.objects.filter(state='published', contributions__contributor=contributor)
+        .exclude(id__in=single_result_contributions.values('course_id')))
+    course_ids = [course_id for course_id, (__, participant_count, voter_count) in get_participant_and_voter_counts(courses).items()
+        if Course.has_enough_voters(voter_count, participant_count)]
+
+    answer_counts = {}
+    answer_count_sums = (RatingAnswerCounter.objects.filter(contribution__contributor=contributor, contribution__course_id__in=course_ids)
+        .values('contribution__course__semester_id', 'question_id', 'answer').annotate(count_sum=Sum('count')).order_by())
+    for answer_count_sum in answer_count_sums:
+        counts = answer_counts.setdefault((answer_count_sum['contribution__course__semester_id'], answer_count_sum['question_id']), [0] * 5)
+        counts[answer_count_sum['answer'] - 1] += answer_count_sum['count_sum']
+    answer_counts = {key: tuple(counts) for key, counts in answer_counts.items()}
+
+    cache.set(cache_key, answer_counts, CONTRIBUTOR_ANSWER_COUNTS_CACHE_TIMEOUT)
+    return answer_counts
+
+
+@receiver(post_transition, sender=Course)
+def delete_contributor_answer_counts(sender, instance, name, **kwargs):
+    if name in ['publish', 'unpublish']:
+        contributor_ids = instance.contributions.exclude(contributor=None).values_list('contributor_id', flat=True)
+        cache.delete_many([get_contributor_answer_counts_cache_key(contributor_id) for contributor_id in contributor_ids])
+
+
+# see get_contributor_trends
+QuestionTrend = namedtuple('QuestionTrend', ('question', 'semester_results', 'total_result'))
+QuestionnaireTrend = namedtuple('QuestionnaireTrend', ('questionnaire', 'semester_averages', 'total_average', 'question_trends'))
+
+
+def get_contributor_trends(contributor):
+    """Returns the semesters the contributor got answers in, ordered by their creation, and a list of
+    `QuestionnaireTrend`s. Each of them contains the averages of the questionnaire's likert and grade
+    answers per semester and in total and a `QuestionTrend` per rating question. Those contain a
+    `RatingResult` or `YesNoResult` per semester and one of all answers given in any semester."""
+    answer_counts = get_contributor_answer_counts(contributor)
+    semester_ids = {semester_id for semester_id, __ in answer_counts.keys()}
+    question_ids = {question_id for __, question_id in answer_counts.keys()}
+    semesters = sorted(Semester.objects.filter(id__in=semester_ids), key=lambda semester: (semester.created_at, semester.id))
+    questionnaires = sorted(Questionnaire.objects.filter(question__id__in=question_ids).distinct().prefetch_related('question_set'))
+
+    no_answers = (0, ) * 5
+    questionnaire_trends = []
+    for questionnaire in questionnaires:
+        question_trends = []
+        # the likert and grade answers of the questionnaire, per semester
+        summed_counts = [defaultdict(int) for __ in semesters]
+        for question in questionnaire.question_set.all():
+            if not question.is_rating_question:
+                continue
+            semester_counts = [get_counts(question, answer_counts.get((semester.id, question.id), no_answers)) for semester in semesters]
+            total_counts = OrderedDict((answer, sum(counts[answer] for counts in semester_counts)) for answer in semester_counts[0].keys())
+            if sum(total_counts.values()) == 0:
+                continue
+            question_trends.append(QuestionTrend(
+                question,
+                [create_rating_result(question, counts, 0) for counts in semester_counts],
+                create_rating_result(question, total_counts, 0)
+            ))
+            if question.is_likert_question or question.is_grade_question:
+                for summed, counts in zip(summed_counts, semester_counts):
+                    for answer, count in counts.items():
+                        summed[answer] += count
+
+        if not question_trends:
+            continue
+        total_summed_counts = defaultdict(int)
+        for summed in summed_counts:
+            for answer, count in summed.items():
+                total_summed_counts[answer] += count
+        questionnaire_trends.append(QuestionnaireTrend(
+            questionnaire,
+            [calculate_statistics(summed)[1] for summed in summed_counts],
+            calculate_statistics(total_summed_counts)[1],
+            question_trends
+        ))
+    return semesters, questionnaire_trends
 
 
 def color_mix(color1, color2, fraction):
@@ -1,13 +1,20 @@
 from collections import OrderedDict, namedtuple
+import hashlib
 
+from django.core.cache import caches
 from django.core.exceptions import PermissionDenied
+from django.db.models import Count, Exists, Max, OuterRef, Prefetch, Q
 from django.shortcuts import get_object_or_404, render
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
+from django.utils import translation
 
-from evap.evaluation.models import Semester, Degree, Contribution
+from evap.evaluation.models import Semester, Degree, Contribution, Course, Questionnaire
 from evap.evaluation.auth import internal_required
-from evap.results.tools import calculate_results, calculate_average_grades_and_deviation, TextResult, RatingResult, \
-    HeadingResult, COMMENT_STATES_REQUIRED_FOR_VISIBILITY, YesNoResult
+from evap.evaluation.tools import add_validators, get_etag, get_not_modified_response
+from evap.results.tools import calculate_results, calculate_uncached_results_for_courses, calculate_average_grades_and_deviation_for_courses, \
+    calculate_average_grades_and_deviation_from_results, TextResult, RatingResult, HeadingResult, \
+    COMMENT_STATES_REQUIRED_FOR_VISIBILITY, YesNoResult
 
 
 @internal_required
@@ -17,21 +24,70 @@ def index(request):
     return render(request, "results_index.html", dict(semesters=semesters))
 
 
+def get_visible_courses_with_prefetched_data(semester, user, visible_states):
+    """Returns the courses of the semester in the given states that the user can see, with everything
+    the semester detail page shows. The number of queries does not depend on the number of courses."""
+    represented_user_ids = [user.id] + list(user.represented_users.values_list('id', flat=True))
+    single_result_contributions = Contribution.objects.filter(course=OuterRef('pk'), responsible=True,
+        questionnaires__name_en=Questionnaire.SINGLE_RESULT_QUESTIONNAIRE_NAME)
+    courses = (semester.course_set.filter(state__in=visible_states)
+        .select_related('type')
+        .prefetch_related(
+            Prefetch("contributions", queryset=Contribution.objects.filter(responsible=True).select_related("contributor").order_by("order"), to_attr="responsible_contributions"),
+            "degrees"
+        ).annotate(
+            is_user_contributor_or_delegate=Exists(Contribution.objects.filter(course=OuterRef('pk'), contributor_id__in=represented_user_ids)),
+            is_user_participant=Exists(Course.participants.through.objects.filter(course=OuterRef('pk'), userprofile=user)),
+            has_single_result_questionnaire=Exists(single_result_contributions),
+        )
+    )
+
+    # the same as Course.can_user_see_course
+    if not user.is_reviewer:
+        visible = Q(is_user_contributor_or_delegate=True) | Q(is_user_participant=True)
+        if not user.is_external:
+            visible |= Q(is_private=False)
+        courses = courses.filter(visible)
+
+    # counting participants and voters in the query above would multiply the joined rows, see staff.views.get_courses_with_prefetched_data
+    participant_counts = dict(semester.course_set.filter(state__in=visible_states).annotate(num_participants=Count("participants")).values_list("id", "num_participants"))
+    voter_counts = dict(semester.course_set.filter(state__in=visible_states).annotate(num_voters=Count("voters")).values_list("id", "num_voters"))
+
+    courses = list(courses)
+    for course in courses:
+        course.responsible_contributors = [contribution.contributor for contribution in course.responsible_contributions]
+        if course._participant_count is None:
+            course.num_participants = participant_counts[course.id]
+            course.num_voters = voter_counts[course.id]
+        # these are the same as Course.is_single_result, can_publish_grades and can_user_see_results, which need queries per course
+        course.is_single_result_annotated = course.has_single_result_questionnaire and course.vote_start_datetime.date() == course.vote_end_date
+        course.grades_publishable = not course.is_single_result_annotated and Course.has_enough_voters(course.num_voters, course.num_participants)
+        course.user_can_see_results = user.is_reviewer or (course.state == 'published' and (course.is_user_contributor_or_delegate or course.grades_publishable))
+    return courses
+
+
 @internal_required
 def semester_detail(request, semester_id):
     semester = get_object_or_404(Semester, id=semester_id)
 
+    etag = get_etag(semester.data_version, request.user.id, translation.get_language())
+    not_modified_response = get_not_modified_response(request, etag)
+    if not_modified_response:
+        return not_modified_response
+
     visible_states = ['published']
     if request.user.is_reviewer:
         visible_states += ['in_evaluation', 'evaluated', 'reviewed']
 
-    courses = semester.course_set.filter(state__in=visible_states).prefetch_related("degrees")
+    courses = get_visible_courses_with_prefetched_data(semester, request.user, visible_states)
 
-    courses = [course for course in courses if course.can_user_see_course(request.user)]
+    # the results cache is not used here, reading it would need a query per course
+    average_grades_and_deviations = calculate_average_grades_and_deviation_for_courses(courses)
+    single_results = calculate_uncached_results_for_courses(course for course in courses if course.is_single_result_annotated)
 
     # Annotate each course object with its grades.
     for course in courses:
-        course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation(course)
+        course.avg_grade, course.avg_deviation = average_grades_and_deviations[course.id]
 
     CourseTuple = namedtuple('CourseTuple', ('courses', 'single_results'))
 
@@ -39,9 +95,9 @@ def semester_detail(request, semester_id):
     for degree in Degree.objects.all():
         courses_by_degree[degree] = CourseTuple([], [])
     for course in courses:
-        if course.is_single_result:
+        if course.is_single_result_annotated:
             for degree in course.degrees.all():
-                section = calculate_results(course)[0]
+                section = single_results[course.id][0]
                 result = section.results[0]
                 courses_by_degree[degree].single_results.append((course, result))
         else:
@@ -49,46 +105,43 @@ def semester_detail(request, semester_id):
                 courses_by_degree[degree].courses.append(course)
 
     template_data = dict(semester=semester, courses_by_degree=courses_by_degree)
-    return render(request, "results_semester_detail.html", template_data)
-
-
-@login_required
-def course_detail(request, semester_id, course_id):
-    semester = get_object_or_404(Semester, id=semester_id)
-    course = get_object_or_404(semester.course_set, id=course_id, semester=semester)
+    return add_validators(render(request, "results_semester_detail.html", template_data), etag)
 
-    if not course.can_user_see_results(request.user):
-        raise PermissionDenied
 
-    sections = calculate_results(course)
+# parts of the results page that look the same for all users of a visibility class, see course_detail
+RENDERED_RESULTS_FRAGMENTS = ['overview', 'sections']
+# only the visibility classes shared by many users are cached, contributors see their own text answers
+SHARED_VISIBILITY_CLASSES = ['public', 'reviewer']
+# changes of contributions or users don't change the version of the rendered results, so they expire quickly
+RENDERED_RESULTS_CACHE_TIMEOUT = 10 * 60
 
-    if request.user.is_reviewer:
-        public_view = request.GET.get('public_view') != 'false'  # if parameter is not given, show public view.
-    else:
-        public_view = request.GET.get('public_view') == 'true'  # if parameter is not given, show own view.
 
-    # If grades are not published, there is no public view
-    if not course.can_publish_grades:
-        public_view = False
+def get_rendered_results_cache_key(fragment, version):
+    return 'evap.results.views.rendered_results-{}-{}'.format(fragment, hashlib.sha1(version.encode()).hexdigest())
 
-    represented_users = list(request.user.represented_users.all())
-    represented_users.append(request.user)
 
-    show_grades = request.user.is_reviewer or course.can_publish_grades
+def get_course_sections(course, text_answer_visibility, show_grades):
+    """Returns the course's result sections without the contributors and the contributors' result sections
+    as shown to a user with the given text answer visibility. Sets the course's average grade and deviation."""
+    course_results = calculate_results(course)
+    sections = course_results
 
     # filter text answers
+    filtered_sections = []
     for section in sections:
         results = []
         for result in section.results:
             if isinstance(result, TextResult):
-                answers = [answer for answer in result.answers if user_can_see_text_answer(request.user, represented_users, answer, public_view)]
+                answers = tuple(answer for answer in result.answers if text_answer_visibility.can_see(answer))
                 if answers:
                     results.append(TextResult(question=result.question, answers=answers))
             else:
                 results.append(result)
-        section.results[:] = results
+        filtered_sections.append(section._replace(results=tuple(results)))
+    sections = filtered_sections
 
     # filter empty headings
+    filtered_sections = []
     for section in sections:
         filtered_results = []
         for index in range(len(section.results)):
@@ -98,7 +151,8 @@ def course_detail(request, semester_id, course_id):
                 if index == len(section.results) - 1 or isinstance(section.results[index + 1], HeadingResult):
                     continue
             filtered_results.append(result)
-        section.results[:] = filtered_results
+        filtered_sections.append(section._replace(results=tuple(filtered_results)))
+    sections = filtered_sections
 
     # remove empty sections
     sections = [section for section in sections if section.results]
@@ -123,54 +177,153 @@ def course_detail(request, semester_id, course_id):
                     if show_grades:
                         contributor_sections[section.contributor]['total_votes'] += result.total_count
 
+    course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation_from_results(course_results)
+
+    return course_sections, contributor_sections
+
+
+@login_required
+def course_detail(request, semester_id, course_id):
+    semester = get_object_or_404(Semester, id=semester_id)
+    course = get_object_or_404(semester.course_set, id=course_id, semester=semester)
+
+    if request.user.is_reviewer:
+        public_view = request.GET.get('public_view') != 'false'  # if parameter is not given, show public view.
+    else:
+        public_view = request.GET.get('public_view') == 'true'  # if parameter is not given, show own view.
+
+    # these need queries, so they are only determined once
+    is_single_result = course.is_single_result
+    can_publish_grades = course.can_publish_grades
+
+    # If grades are not published, there is no public view
+    if not can_publish_grades:
+        public_view = False
+
+    represented_users = list(request.user.represented_users.all())
+    represented_users.append(request.user)
+
+    text_answer_visibility = TextAnswerVisibility(request.user, represented_users, course, public_view)
+    is_contributor = text_answer_visibility.is_user_contributor_or_delegate
+
+    # the same as Course.can_user_see_results
+    if not request.user.is_reviewer:
+        if course.state != 'published':
+            raise PermissionDenied
+        if not is_contributor and not (can_publish_grades and course.can_user_see_course(request.user)):
+            raise PermissionDenied
+
+    show_grades = request.user.is_reviewer or can_publish_grades
+
+    # all users of the same visibility class see the same results, so they are rendered once and cached if the class is shared
+    rendered_results_version = '{:d}-{}-{}-{}-{}'.format(course.id, course.data_version, translation.get_language(),
+        text_answer_visibility.visibility_class, show_grades)
+
+    # the rest of the page depends on the user and the course's grade documents
+    grade_documents = course.grade_documents.aggregate(count=Count('id'), last_modified_time=Max('last_modified_time'))
+    etag = get_etag(rendered_results_version, request.user.id, public_view, grade_documents['count'], grade_documents['last_modified_time'])
+    not_modified_response = get_not_modified_response(request, etag)
+    if not_modified_response:
+        return not_modified_response
+
+    rendered_results_cache = caches['rendered_results']
+    use_rendered_results_cache = text_answer_visibility.visibility_class in SHARED_VISIBILITY_CLASSES
+    cache_keys = {get_rendered_results_cache_key(fragment, rendered_results_version): fragment for fragment in RENDERED_RESULTS_FRAGMENTS}
+    rendered_results = {}
+    if use_rendered_results_cache:
+        rendered_results = {cache_keys[cache_key]: content for cache_key, content in rendered_results_cache.get_many(cache_keys.keys()).items()}
+    if len(rendered_results) < len(RENDERED_RESULTS_FRAGMENTS):
+        course_sections, contributor_sections = get_course_sections(course, text_answer_visibility, show_grades)
+        fragment_data = dict(course=course, is_single_result=is_single_result, course_sections=course_sections, contributor_sections=contributor_sections,
+            show_grades=show_grades)
+        rendered_results = {fragment: render_to_string("results_course_detail_{}.html".format(fragment), fragment_data, request)
+            for fragment in RENDERED_RESULTS_FRAGMENTS}
+        if use_rendered_results_cache:
+            rendered_results_cache.set_many({cache_key: rendered_results[fragment] for cache_key, fragment in cache_keys.items()}, RENDERED_RESULTS_CACHE_TIMEOUT)
+
     # Show a warning if course is still in evaluation (for reviewer preview).
     evaluation_warning = course.state != 'published'
 
     # Results for a course might not be visible because there are not enough answers
     # but it can still be "published" e.g. to show the comment results to contributors.
     # Users who can open the results page see a warning message in this case.
-    sufficient_votes_warning = not course.can_publish_grades
-
-    course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation(course)
+    sufficient_votes_warning = not can_publish_grades
 
     template_data = dict(
             course=course,
-            course_sections=course_sections,
-            contributor_sections=contributor_sections,
+            rendered_results=rendered_results,
             evaluation_warning=evaluation_warning,
             sufficient_votes_warning=sufficient_votes_warning,
             show_grades=show_grades,
             reviewer=request.user.is_reviewer,
-            contributor=course.is_user_contributor_or_delegate(request.user),
+            contributor=is_contributor,
             can_download_grades=request.user.can_download_grades,
             public_view=public_view)
-    return render(request, "results_course_detail.html", template_data)
-
+    return add_validators(render(request, "results_course_detail.html", template_data), etag)
+
+
+class TextAnswerVisibility:
+    """Decides which text answers of a course a user can see. Everything the decision depends on is loaded once,
+    so checking the answers themselves doesn't need any queries."""
+
+    def __init__(self, user, represented_users, course, public_view=False):
+        self.user_id = user.id
+        self.is_reviewer = user.is_reviewer
+        self.public_view = public_view
+        # represented_users contains the user and everyone who made the user a delegate
+        self.represented_user_ids = {represented_user.id for represented_user in represented_users}
+
+        self.contributions = {}
+        self.can_see_all_comments = False
+        self.can_see_course_comments = False
+        for contribution_id, contributor_id, responsible, comment_visibility in (course.contributions
+                .values_list('id', 'contributor_id', 'responsible', 'comment_visibility')):
+            self.contributions[contribution_id] = (contributor_id, responsible)
+            if contributor_id in self.represented_user_ids:
+                if comment_visibility == Contribution.ALL_COMMENTS:
+                    self.can_see_all_comments = True
+                elif comment_visibility == Contribution.COURSE_COMMENTS:
+                    self.can_see_course_comments = True
+
+    def can_see(self, text_answer):
+        if self.public_view:
+            return False
+        if text_answer.state not in COMMENT_STATES_REQUIRED_FOR_VISIBILITY:
+            return False
+        if self.is_reviewer:
+            return True
 
-def user_can_see_text_answer(user, represented_users, text_answer, public_view=False):
-    if public_view:
-        return False
-    if text_answer.state not in COMMENT_STATES_REQUIRED_FOR_VISIBILITY:
-        return False
-    if user.is_reviewer:
-        return True
+        contributor_id, responsible = self.contributions[text_answer.contribution_id]
 
-    contributor = text_answer.contribution.contributor
+        if text_answer.is_private:
+            return contributor_id == self.user_id
 
-    if text_answer.is_private:
-        return contributor == user
+        if text_answer.is_published:
+            if responsible:
+                return contributor_id in self.represented_user_ids
 
-    if text_answer.is_published:
-        if text_answer.contribution.responsible:
-            return contributor == user or user in contributor.delegates.all()
+            if contributor_id in self.represented_user_ids:
+                return True
+            if self.can_see_all_comments:
+                return True
+            if contributor_id is None and self.can_see_course_comments:
+                return True
 
-        if contributor in represented_users:
-            return True
-        if text_answer.contribution.course.contributions.filter(
-                contributor__in=represented_users, comment_visibility=Contribution.ALL_COMMENTS).exists():
-            return True
-        if text_answer.contribution.is_general and text_answer.contribution.course.contributions.filter(
-                contributor__in=represented_users, comment_visibility=Contribution.COURSE_COMMENTS).exists():
-            return True
+        return False
 
-    return False
+    @property
+    def is_user_contributor_or_delegate(self):
+        """The same as Course.is_user_contributor_or_delegate."""
+        return any(contributor_id in self.represented_user_ids for contributor_id, __ in self.contributions.values())
+
+    @property
+    def visibility_class(self):
+        """Identifies the users seeing the same text answers of the course."""
+        if self.public_view:
+            return 'public'
+        if self.is_reviewer:
+            return 'reviewer'
+        if not self.is_user_contributor_or_delegate:
+            # users not contributing to the course and not representing a contributor can't see any text answers
+            return 'public'
+        return 'contributor-{:d}-{}'.format(self.user_id, ','.join(str(user_id) for user_id in sorted(self.represented_user_ids)))
@@ -38,6 +38,9 @@ MIN_ANSWER_PERCENTAGE = 0.2
 RESULTS_WARNING_COUNT = 4
 RESULTS_WARNING_PERCENTAGE = 0.5
 
+# number of threads gathering the data of the sheets of a results export in parallel
+EXPORT_SHEET_WORKERS = 4
+
 # the final total grade will be calculated by the following formula (GP = GRADE_PERCENTAGE, CP = CONTRIBUTION_PERCENTAGE):
 # final_likert = CP * likert_answers_about_persons + (1-CP) * likert_answers_about_courses
 # final_grade = CP * grade_answers_about_persons + (1-CP) * grade_answers_about_courses
@@ -101,9 +104,20 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
         'LOCATION': 'evap_db_cache',
         'OPTIONS': {
-            'MAX_ENTRIES': 1000  # note that the results alone need one entry per course
+            # the results need up to two entries per course and the answer counts of the courses in evaluation
+            # one more. the database cache culls entries in key order, so this must fit all of them.
+            'MAX_ENTRIES': 5000
         }
-    }
+    },
+    # the rendered parts of the results pages are kept apart, so they can't push the results out of the default cache.
+    # they need up to two entries per course, language and shared visibility class, see evap.results.views.course_detail
+    'rendered_results': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'evap_rendered_results_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000
+        }
+    },
 }
 
 CONTACT_EMAIL = "webmaster@localhost"
@@ -323,6 +337,7 @@ TESTING = 'test' in sys.argv
 if TESTING:
     COMPRESS_PRECOMPILERS = ()  # disable django-compressor
     logging.disable(logging.CRITICAL)  # disable logging, primarily to prevent console spam
+    EXPORT_SHEET_WORKERS = 1  # other threads can't see the data of the running test's transaction
 
 
 # Django debug toolbar settings
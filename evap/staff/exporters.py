@@ -0,0 +1,364 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import translation
+from django.utils.translation import ugettext as _
+
+from evap.evaluation.models import Contribution, Course, CourseType, Degree, ExportJob, Question, Questionnaire, RatingAnswerCounter, UserProfile
+from evap.results.exporters import ExcelExporter, XlsxExporter
+from evap.results.tools import calculate_average_grades_and_deviation_for_courses
+from evap.rewards.models import RewardPointGranting
+
+logger = logging.getLogger(__name__)
+
+# generated export files are cached in this subdirectory of MEDIA_ROOT
+EXPORT_CACHE_DIRECTORY = 'export_cache'
+
+EXPORT_NAMES_VERSION_CACHE_KEY = 'evap.staff.exporters.names_version'
+
+
+def get_export_names_version():
+    """Returns a version of the names of course types, degrees, questionnaires and questions. The exports show
+    them, but changing them doesn't change the data_version of the semesters."""
+    version = cache.get(EXPORT_NAMES_VERSION_CACHE_KEY)
+    if version is None:
+        # a lost version is replaced by a new one, so outdated exports are never considered current
+        cache.add(EXPORT_NAMES_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        version = cache.get(EXPORT_NAMES_VERSION_CACHE_KEY)
+    return version
+
+
+@receiver([post_save, post_delete], sender=CourseType)
+@receiver([post_save, post_delete], sender=Degree)
+@receiver([post_save, post_delete], sender=Questionnaire)
+@receiver([post_save, post_delete], sender=Question)
+def invalidate_export_names_version(sender, **kwargs):
+    cache.set(EXPORT_NAMES_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+
+def get_courses_for_raw_export(semester):
+    """Returns the courses of the semester annotated with everything the raw export shows."""
+    single_result_contributions = Contribution.objects.filter(course=OuterRef('pk'), responsible=True,
+        questionnaires__name_en=Questionnaire.SINGLE_RESULT_QUESTIONNAIRE_NAME)
+    courses = (semester.course_set
+        .select_related('type')
+        .prefetch_related('degrees')
+        .annotate(
+            num_comments=Count("contributions__textanswer_set", distinct=True),
+            has_single_result_questionnaire=Exists(single_result_contributions),
+        )
+    )
+
+    # counting participants and voters in the query above would multiply the joined rows, see get_courses_with_prefetched_data
+    participant_counts = dict(semester.course_set.annotate(num_participants=Count("participants")).values_list("id", "num_participants"))
+    voter_counts = dict(semester.course_set.annotate(num_voters=Count("voters")).values_list("id", "num_voters"))
+    for course in courses:
+        if course._participant_count is None:
+            course.num_participants = participant_counts[course.id]
+            course.num_voters = voter_counts[course.id]
+    return courses
+
+
+def raw_export_rows(semester, include_answer_counters=False, progress=None):
+    """Yields the rows of the raw export of the semester. If include_answer_counters is set, the course rows are
+    followed by every rating answer counter of the semester's courses."""
+    yield [_('Name'), _('Degrees'), _('Type'), _('Single result'), _('State'), _('#Voters'),
+        _('#Participants'), _('#Comments'), _('Average grade')]
+    courses = get_courses_for_raw_export(semester)
+    evaluated_courses = [course for course in courses if course.state in ['evaluated', 'reviewed', 'published']]
+    average_grades_and_deviations = calculate_average_grades_and_deviation_for_courses(evaluated_courses)
+    for counter, course in enumerate(courses):
+        if progress:
+            progress(counter / len(courses))
+        degrees = ", ".join([degree.name for degree in course.degrees.all()])
+        avg_grade = average_grades_and_deviations.get(course.id, (None, None))[0]
+        # the same as Course.is_single_result, which needs a query per course
+        is_single_result = course.has_single_result_questionnaire and course.vote_start_datetime.date() == course.vote_end_date
+        yield [course.name, degrees, course.type.name, is_single_result, course.state,
+            course.num_voters, course.num_participants, course.num_comments, "" if avg_grade is None else "{:.1f}".format(avg_grade)]
+
+    if not include_answer_counters:
+        return
+    yield []
+    yield [_('Course'), _('Contributor'), _('Questionnaire'), _('Question'), _('Answer'), _('Count')]
+    answer_counters = (RatingAnswerCounter.objects.filter(contribution__course__semester=semester)
+        .select_related('contribution__course', 'contribution__contributor', 'question__questionnaire')
+        .order_by('contribution__course__name_de', 'contribution__course_id', 'contribution_id', 'question__questionnaire__index', 'question__order', 'answer'))
+    for answer_counter in answer_counters.iterator():
+        contributor = answer_counter.contribution.contributor
+        yield [answer_counter.contribution.course.name, contributor.full_name if contributor else "", answer_counter.question.questionnaire.name,
+            answer_counter.question.text, answer_counter.answer, answer_counter.count]
+
+
+def export_raw(semester, output, progress=None, include_answer_counters=False):
+    """Writes the raw course data of the semester as CSV to the text stream output."""
+    writer = csv.writer(output, delimiter=";")
+    writer.writerows(raw_export_rows(semester, include_answer_counters, progress))
+
+
+class Echo:
+    """Implements just the write method of a file, returning the written value instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    """Returns an iterator over the CSV lines of the given rows that can be passed to a StreamingHttpResponse."""
+    writer = csv.writer(Echo(), delimiter=";")
+    # the rows are created while the response is sent, after the request's language might have been reset
+    language = translation.get_language()
+
+    def lines():
+        with translation.override(language):
+            for row in rows:
+                yield writer.writerow(row)
+    return lines()
+
+
+def get_participants_for_participation_export(semester):
+    """Returns the participants of the semester annotated with their number of courses and votes and whether
+    they earned reward points, in a single query."""
+    def count_courses(relation, is_required_for_reward):
+        return Count(relation, distinct=True, filter=Q(**{
+            relation + '__semester': semester,
+            relation + '__is_required_for_reward': is_required_for_reward,
+        }))
+
+    return (UserProfile.objects
+        .filter(courses_participating_in__semester=semester)
+        .annotate(
+            num_required_courses=count_courses('courses_participating_in', True),
+            num_required_courses_voted_for=count_courses('courses_voted_for', True),
+            num_optional_courses=count_courses('courses_participating_in', False),
+            num_optional_courses_voted_for=count_courses('courses_voted_for', False),
+            earned_reward_points=Exists(RewardPointGranting.objects.filter(semester=semester, user_profile=OuterRef('pk'))),
+        )
+        .order_by("username")
+    )
+
+
+def get_participation_data_version(semester):
+    """Returns a string that changes whenever the participation export of the semester changes. Besides the semester's
+    courses, the export depends on their participants and voters, the participants' usernames and email addresses,
+    which decide whether they are external, and the reward points granted in the semester."""
+    enrollments = sorted(Course.participants.through.objects.filter(course__semester=semester)
+        .values_list('course_id', 'userprofile__username', 'userprofile__email'))
+    votes = Course.voters.through.objects.filter(course__semester=semester).aggregate(count=Count('id'), id_sum=Sum('id'))
+    granted_user_ids = sorted(RewardPointGranting.objects.filter(semester=semester).values_list('user_profile_id', flat=True))
+    version = repr((semester.data_version, enrollments, votes, granted_user_ids, settings.INSTITUTION_EMAIL_DOMAINS))
+    return hashlib.sha1(version.encode()).hexdigest()
+
+
+def get_export_data_version(semester, export_type):
+    """Returns a string that changes whenever the given export of the semester changes."""
+    if export_type == ExportJob.PARTICIPATION:
+        return get_participation_data_version(semester)
+    return '{}-{}'.format(semester.data_version, get_export_names_version())
+
+
+def participation_export_rows(semester, progress=None):
+    """Yields the rows of the participation export of the semester."""
+    yield [_('Username'), _('Can use reward points'), _('#Required courses voted for'),
+        _('#Required courses'), _('#Optional courses voted for'), _('#Optional courses'), _('Earned reward points')]
+    participants = get_participants_for_participation_export(semester)
+    for counter, participant in enumerate(participants):
+        if progress:
+            progress(counter / len(participants))
+        yield [
+            # all participants of the semester are participants, so this is the same as can_user_use_reward_points
+            participant.username, not participant.is_external, participant.num_required_courses_voted_for,
+            participant.num_required_courses, participant.num_optional_courses_voted_for, participant.num_optional_courses,
+            participant.earned_reward_points
+        ]
+
+
+def export_participation(semester, output, progress=None):
+    """Writes the participation data of the semester as CSV to the text stream output."""
+    writer = csv.writer(output, delimiter=";")
+    writer.writerows(participation_export_rows(semester, progress))
+
+
+# name, type and lookup of the columns of the analytics dump, in their order
+ANALYTICS_COLUMNS = [
+    ('semester_id', 'int', 'contribution__course__semester_id'),
+    ('semester', 'str', 'contribution__course__semester__name_en'),
+    ('course_id', 'int', 'contribution__course_id'),
+    ('course', 'str', 'contribution__course__name_en'),
+    ('course_type', 'str', 'contribution__course__type__name_en'),
+    ('course_state', 'str', 'contribution__course__state'),
+    ('is_graded', 'bool', 'contribution__course__is_graded'),
+    ('contribution_id', 'int', 'contribution_id'),
+    ('contributor_id', 'int', 'contribution__contributor_id'),
+    ('questionnaire_id', 'int', 'question__questionnaire_id'),
+    ('questionnaire', 'str', 'question__questionnaire__name_en'),
+    ('question_id', 'int', 'question_id'),
+    ('question', 'str', 'question__text_en'),
+    ('question_type', 'str', 'question__type'),
+    ('answer', 'int', 'answer'),
+    ('count', 'int', 'count'),
+]
+ANALYTICS_CHUNK_SIZE = 2000
+
+
+def analytics_rows(semesters):
+    """Yields one row per rating answer counter of the given semesters with the metadata of its course and question.
+    The first two rows contain the names and types of the columns. The degrees of a course are added as the last
+    column, separated by commas."""
+    yield [name for name, __, __ in ANALYTICS_COLUMNS] + ['degrees']
+    yield [column_type for __, column_type, __ in ANALYTICS_COLUMNS] + ['str']
+
+    # joining the degrees would repeat the counters of courses with multiple degrees
+    degrees = defaultdict(list)
+    for course_id, degree_name in (Course.degrees.through.objects.filter(course__semester__in=semesters)
+            .order_by('degree__order').values_list('course_id', 'degree__name_en')):
+        degrees[course_id].append(degree_name)
+    degrees = {course_id: ", ".join(names) for course_id, names in degrees.items()}
+
+    course_id_index = [lookup for __, __, lookup in ANALYTICS_COLUMNS].index('contribution__course_id')
+    answer_counters = (RatingAnswerCounter.objects.filter(contribution__course__semester__in=semesters)
+        .order_by('contribution__course__semester_id', 'contribution__course_id', 'contribution_id', 'question_id', 'answer')
+        .values_list(*[lookup for __, __, lookup in ANALYTICS_COLUMNS]))
+    # on PostgreSQL, the iterator fetches the rows in chunks using a server-side cursor
+    for row in answer_counters.iterator(chunk_size=ANALYTICS_CHUNK_SIZE):
+        yield row + (degrees.get(row[course_id_index], ""),)
+
+
+def export_analytics(semesters, output):
+    """Writes the analytics dump of the semesters as gzip compressed CSV to the binary file output."""
+    with gzip.GzipFile(fileobj=output, mode='wb') as compressed_output:
+        text_output = io.TextIOWrapper(compressed_output, encoding='utf-8', newline='')
+        csv.writer(text_output, delimiter=";").writerows(analytics_rows(semesters))
+        text_output.detach()
+
+
+def stream_analytics(semesters):
+    """Returns an iterator over the gzip compressed CSV chunks of the analytics dump of the semesters that can
+    be passed to a StreamingHttpResponse."""
+    buffer = io.BytesIO()
+    compressed_output = gzip.GzipFile(fileobj=buffer, mode='wb')
+    text_output = io.TextIOWrapper(compressed_output, encoding='utf-8', newline='', write_through=True)
+    writer = csv.writer(text_output, delimiter=";")
+
+    def take_buffer_content():
+        content = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return content
+
+    def chunks():
+        for counter, row in enumerate(analytics_rows(semesters), 1):
+            writer.writerow(row)
+            if counter % ANALYTICS_CHUNK_SIZE == 0:
+                yield take_buffer_content()
+        text_output.detach()
+        compressed_output.close()
+        yield take_buffer_content()
+    return chunks()
+
+
+def export_filename(semester, export_type):
+    return {
+        ExportJob.RESULTS_XLS: "Evaluation-{}-{}.xls",
+        ExportJob.RESULTS_XLSX: "Evaluation-{}-{}.xlsx",
+        ExportJob.RAW: "Evaluation-{}-{}_raw.csv",
+        ExportJob.PARTICIPATION: "Evaluation-{}-{}_participation.csv",
+    }[export_type].format(semester.name, translation.get_language())
+
+
+def write_export(semester, export_type, parameters, output, progress=None):
+    """Writes the export of the given type in the current language to the binary file output."""
+    if export_type == ExportJob.RESULTS_XLS:
+        ExcelExporter(semester).export(output, progress=progress, **parameters)
+    elif export_type == ExportJob.RESULTS_XLSX:
+        XlsxExporter(semester).export(output, progress=progress, **parameters)
+    else:
+        text_output = io.TextIOWrapper(output, encoding='utf-8', newline='')
+        export_function = export_raw if export_type == ExportJob.RAW else export_participation
+        export_function(semester, text_output, progress=progress, **parameters)
+        text_output.detach()
+
+
+def get_cached_export(semester, export_type, parameters):
+    """Returns the path of a file containing the given export in the current language. The file is created
+    if it does not exist yet. Files are named after the export's data version and settings, so changes to
+    the semester's courses or answers or to the names shown in the export automatically lead to a new file."""
+    directory = os.path.join(settings.MEDIA_ROOT, EXPORT_CACHE_DIRECTORY, str(semester.id))
+    version_hash = hashlib.sha1(get_export_data_version(semester, export_type).encode()).hexdigest()[:16]
+    export_key = json.dumps(dict(export_type=export_type, language=translation.get_language(), parameters=parameters), sort_keys=True)
+    extension = os.path.splitext(export_filename(semester, export_type))[1]
+    path = os.path.join(directory, '{}-{}{}'.format(version_hash, hashlib.sha1(export_key.encode()).hexdigest(), extension))
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(directory, exist_ok=True)
+    # the file is written under a temporary name first, so concurrent requests never serve incomplete files
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='tmp', delete=False) as output:
+        try:
+            write_export(semester, export_type, parameters, output)
+        except Exception:
+            output.close()
+            os.remove(output.name)
+            raise
+    os.replace(output.name, path)
+
+    # files of earlier data versions can't be requested anymore
+    for filename in os.listdir(directory):
+        if not filename.startswith(version_hash) and not filename.startswith('tmp'):
+            os.remove(os.path.join(directory, filename))
+    return path
+
+
+def queue_export_job(semester, export_type, parameters, user):
+    """Returns a job creating the given export in the current language. If the same export was already
+    requested and its data did not change since then, the existing job is returned instead of a new one."""
+    parameters = json.dumps(parameters, sort_keys=True)
+    language = translation.get_language()
+    data_version = get_export_data_version(semester, export_type)
+    existing_job = ExportJob.objects.filter(semester=semester, export_type=export_type, parameters=parameters, language=language,
+                                            data_version=data_version, state__in=[ExportJob.QUEUED, ExportJob.RUNNING, ExportJob.DONE]).first()
+    if existing_job:
+        return existing_job
+    return ExportJob.objects.create(semester=semester, export_type=export_type, parameters=parameters, language=language,
+                                    data_version=data_version, requested_by=user)
+
+
+def run_export_job(job):
+    """Creates the export of the given job and stores it in the job's file. Returns False if
+    the job was already started by another worker."""
+    if ExportJob.objects.filter(pk=job.pk, state=ExportJob.QUEUED).update(state=ExportJob.RUNNING) != 1:
+        return False
+    job.state = ExportJob.RUNNING
+
+    def progress(fraction):
+        ExportJob.objects.filter(pk=job.pk).update(progress=int(fraction * 100))
+
+    parameters = json.loads(job.parameters)
+    try:
+        with translation.override(job.language), tempfile.TemporaryFile() as output:
+            write_export(job.semester, job.export_type, parameters, output, progress=progress)
+            output.seek(0)
+            job.file.save(export_filename(job.semester, job.export_type), File(output), save=False)
+        job.state = ExportJob.DONE
+    except Exception:
+        logger.exception('An error occurred when running the export job {}.'.format(job.id))
+        job.state = ExportJob.FAILED
+    job.progress = 100
+    job.finished_at = datetime.now()
+    job.save()
+    return True
@@ -259,6 +259,7 @@ class SingleResultForm(forms.ModelForm):
             count = self.cleaned_data['answer_' + str(i)]
             total_votes += count
             RatingAnswerCounter.objects.update_or_create(contribution=contribution, question=single_result_question, answer=i, defaults={'count': count})
+        self.instance.bump_answer_data_version()
         self.instance._participant_count = total_votes
         self.instance._voter_count = total_votes
 
@@ -654,6 +655,15 @@ class TextAnswerForm(forms.ModelForm):
         return reviewed_answer
 
 
+class SemesterComparisonExportForm(forms.Form):
+    semesters = forms.ModelMultipleChoiceField(Semester.objects.all(), widget=CheckboxSelectMultiple, label=_("Semesters"))
+    course_types = forms.ModelMultipleChoiceField(CourseType.objects.all(), widget=CheckboxSelectMultiple, label=_("Course types"))
+    include_unpublished = forms.BooleanField(required=False, label=_("Include unpublished courses where the evaluation period ended"))
+    include_not_enough_answers = forms.BooleanField(required=False, label=_("Include courses where not enough answers were given"))
+    file_format = forms.ChoiceField(choices=[('xls', _('Excel 97-2003 (.xls)')), ('xlsx', _('Excel (.xlsx)'))], initial='xls',
+                                    widget=forms.RadioSelect, label=_("File format"))
+
+
 class ExportSheetForm(forms.Form):
     def __init__(self, semester, *args, **kwargs):
         super(ExportSheetForm, self).__init__(*args, **kwargs)
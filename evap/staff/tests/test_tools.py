@@ -92,6 +92,7 @@ class MergeUsersTest(TestCase):
         additional_handled_attrs = {
             'grades_last_modified_user+',
             'course_last_modified_user+',
+            'export_job_requested_by+',
         }
 
         actual_attrs = handled_attrs | additional_handled_attrs
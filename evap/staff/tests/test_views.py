@@ -1,18 +1,25 @@
 import datetime
+import gzip
 import os
 import glob
+import tempfile
 
 from django.conf import settings
 from django.contrib.auth.models import Group
-from django.core import mail
+from django.core import mail, management
+from django.core.cache import cache
+from django.test import override_settings
 from django.urls import reverse
 from model_mommy import mommy
 import xlrd
 
 from evap.evaluation.models import Semester, UserProfile, Course, CourseType, TextAnswer, Contribution, \
                                    Questionnaire, Question, EmailTemplate, Degree, FaqSection, FaqQuestion, \
-                                   RatingAnswerCounter
+                                   RatingAnswerCounter, ExportJob, CourseGrades
 from evap.evaluation.tests.tools import FuzzyInt, WebTest, ViewTest
+from evap.results.tools import get_courses_to_warm_up, get_results_cache_key
+from evap.rewards.models import RewardPointGranting
+from evap.staff.exporters import EXPORT_CACHE_DIRECTORY
 from evap.staff.tools import generate_import_filename
 
 
@@ -613,6 +620,7 @@ class TestSemesterImportView(ViewTest):
         self.assertContains(page, 'Import previously uploaded file')
 
 
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
 class TestSemesterExportView(ViewTest):
     url = '/staff/semester/1/export'
     test_users = ['staff']
@@ -638,6 +646,69 @@ class TestSemesterExportView(ViewTest):
         self.assertEqual(workbook.sheets()[0].row_values(0)[0],
                          'Evaluation {0}\n\n{1}'.format(self.semester.name, ", ".join([self.course_type.name])))
 
+    def test_view_downloads_xlsx_file(self):
+        page = self.app.get(self.url, user='staff')
+        form = page.forms["semester-export-form"]
+        form.set('form-0-selected_course_types', 'id_form-0-selected_course_types_0')
+        form['file_format'] = 'xlsx'
+
+        response = form.submit()
+
+        self.assertIn('.xlsx', response['Content-Disposition'])
+        workbook = xlrd.open_workbook(file_contents=response.body)
+        self.assertEqual(workbook.sheets()[0].row_values(0)[0],
+                         'Evaluation {0}\n\n{1}'.format(self.semester.name, ", ".join([self.course_type.name])))
+
+    def test_exports_are_cached_until_data_changes(self):
+        page = self.app.get(self.url, user='staff')
+        form = page.forms["semester-export-form"]
+        form.set('form-0-selected_course_types', 'id_form-0-selected_course_types_0')
+        cache_directory = os.path.join(settings.MEDIA_ROOT, EXPORT_CACHE_DIRECTORY, str(self.semester.id))
+
+        first_content = form.submit().body
+        cached_files = os.listdir(cache_directory)
+        self.assertEqual(len(cached_files), 1)
+
+        self.assertEqual(form.submit().body, first_content)
+        self.assertEqual(os.listdir(cache_directory), cached_files)
+
+        self.course.save()
+        form.submit()
+        self.assertEqual(len(os.listdir(cache_directory)), 1)
+        self.assertNotEqual(os.listdir(cache_directory), cached_files)
+
+    def test_cached_exports_show_renamed_course_types(self):
+        page = self.app.get(self.url, user='staff')
+        form = page.forms["semester-export-form"]
+        form.set('form-0-selected_course_types', 'id_form-0-selected_course_types_0')
+        form.submit()
+
+        course_type = CourseType.objects.get(pk=self.course_type.pk)
+        course_type.name_en = "Renamed type"
+        course_type.save()
+        workbook = xlrd.open_workbook(file_contents=form.submit().body)
+        self.assertEqual(workbook.sheets()[0].row_values(0)[0], 'Evaluation {0}\n\nRenamed type'.format(self.semester.name))
+
+
+class TestSemesterComparisonExportView(ViewTest):
+    url = '/staff/semester/comparison_export'
+    test_users = ['staff']
+
+    @classmethod
+    def setUpTestData(cls):
+        mommy.make(UserProfile, username='staff', groups=[Group.objects.get(name='Staff')])
+        cls.semesters = mommy.make(Semester, _quantity=2)
+        cls.course_type = mommy.make(CourseType)
+
+    def test_view_downloads_excel_file(self):
+        form = self.app.get(self.url, user='staff').forms["semester-comparison-export-form"]
+        form['semesters'] = [semester.id for semester in self.semesters]
+        form['course_types'] = [self.course_type.id]
+        response = form.submit()
+
+        workbook = xlrd.open_workbook(file_contents=response.body)
+        self.assertEqual(workbook.sheets()[0].row_values(0)[1:4:2], [self.semesters[0].name, self.semesters[1].name])
+
 
 class TestSemesterRawDataExportView(ViewTest):
     url = '/staff/semester/1/raw_export'
@@ -653,8 +724,10 @@ class TestSemesterRawDataExportView(ViewTest):
             voters=[cls.student_user], name_de="Veranstaltung 1", name_en="Course 1")
         cls.course2 = mommy.make(Course, type=cls.course_type, semester=cls.semester, participants=[cls.student_user],
             name_de="Veranstaltung 2", name_en="Course 2")
-        mommy.make(Contribution, course=cls.course1, responsible=True, can_edit=True, comment_visibility=Contribution.ALL_COMMENTS)
-        mommy.make(Contribution, course=cls.course2, responsible=True, can_edit=True, comment_visibility=Contribution.ALL_COMMENTS)
+        mommy.make(Contribution, course=cls.course1, contributor=mommy.make(UserProfile), responsible=True, can_edit=True,
+            comment_visibility=Contribution.ALL_COMMENTS)
+        mommy.make(Contribution, course=cls.course2, contributor=mommy.make(UserProfile), responsible=True, can_edit=True,
+            comment_visibility=Contribution.ALL_COMMENTS)
 
     def test_view_downloads_csv_file(self):
         response = self.app.get(self.url, user='staff')
@@ -665,6 +738,41 @@ class TestSemesterRawDataExportView(ViewTest):
         )
         self.assertEqual(response.content, expected_content.encode("utf-8"))
 
+    def test_not_modified_until_semester_changes(self):
+        etag = self.app.get(self.url, user='staff').headers['ETag']
+        self.app.get(self.url, user='staff', headers={'If-None-Match': etag}, status=304)
+        self.app.get(self.url + '?include_answer_counters=on', user='staff', headers={'If-None-Match': etag}, status=200)
+
+        self.course1.save()
+        response = self.app.get(self.url, user='staff', headers={'If-None-Match': etag}, status=200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.app.get(self.url, user='staff', headers={'If-None-Match': response.headers['ETag']}, status=304)
+
+        course_type = CourseType.objects.get(pk=self.course_type.pk)
+        course_type.name_en = "Renamed type"
+        course_type.save()
+        self.app.get(self.url, user='staff', headers={'If-None-Match': response.headers['ETag']}, status=200)
+
+    def test_number_of_queries_does_not_depend_on_number_of_courses(self):
+        mommy.make(Course, type=self.course_type, semester=self.semester, participants=[self.student_user], _quantity=20)
+        with self.assertNumQueries(FuzzyInt(0, 20)):
+            self.app.get(self.url, user='staff')
+
+    def test_answer_counters_can_be_included(self):
+        questionnaire = mommy.make(Questionnaire, name_en="Questionnaire")
+        question = mommy.make(Question, type="L", questionnaire=questionnaire, text_en="Question")
+        contribution = mommy.make(Contribution, course=self.course1, contributor=mommy.make(UserProfile, first_name="Jane", last_name="Doe"))
+        mommy.make(RatingAnswerCounter, question=question, contribution=self.course1.general_contribution, answer=1, count=4)
+        mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=2, count=3)
+
+        response = self.app.get(self.url + '?include_answer_counters=on', user='staff')
+        self.assertTrue(response.content.decode("utf-8").endswith(
+            "\r\n\r\n"
+            "Course;Contributor;Questionnaire;Question;Answer;Count\r\n"
+            "Course 1;;Questionnaire;Question;1;4\r\n"
+            "Course 1;Jane Doe;Questionnaire;Question;2;3\r\n"
+        ))
+
 
 class TestSemesterParticipationDataExportView(ViewTest):
     url = '/staff/semester/1/participation_export'
@@ -691,6 +799,129 @@ class TestSemesterParticipationDataExportView(ViewTest):
             "student;False;1;1;0;1;False\r\n")
         self.assertEqual(response.content, expected_content.encode("utf-8"))
 
+    def test_reward_point_grantings_and_other_semesters(self):
+        mommy.make(RewardPointGranting, semester=self.semester, user_profile=self.student_user, value=1)
+        mommy.make(Course, type=self.course_type, participants=[self.student_user], voters=[self.student_user], is_required_for_reward=True)
+
+        response = self.app.get(self.url, user='staff')
+        self.assertTrue(response.content.decode("utf-8").endswith("student;False;1;1;0;1;True\r\n"))
+
+    def test_number_of_queries_does_not_depend_on_number_of_participants(self):
+        mommy.make(UserProfile, courses_participating_in=[self.course1], courses_voted_for=[self.course1], _quantity=20)
+        with self.assertNumQueries(FuzzyInt(0, 20)):
+            self.app.get(self.url, user='staff')
+
+    def test_not_modified_until_participation_data_changes(self):
+        def assert_etag_changes(change):
+            etag = self.app.get(self.url, user='staff').headers['ETag']
+            self.app.get(self.url, user='staff', headers={'If-None-Match': etag}, status=304)
+            change()
+            self.app.get(self.url, user='staff', headers={'If-None-Match': etag}, status=200)
+
+        assert_etag_changes(lambda: self.course2.participants.add(mommy.make(UserProfile)))
+        assert_etag_changes(lambda: UserProfile.objects.filter(pk=self.student_user.pk).update(email="student@institution.example.com"))
+        assert_etag_changes(lambda: mommy.make(RewardPointGranting, semester=self.semester, user_profile=self.student_user, value=1))
+
+
+class TestSemesterAnalyticsExportView(ViewTest):
+    url = '/staff/semester/1/analytics_export'
+    test_users = ['staff']
+
+    @classmethod
+    def setUpTestData(cls):
+        mommy.make(UserProfile, username='staff', groups=[Group.objects.get(name='Staff')])
+        cls.semester = mommy.make(Semester, pk=1, name_en="Semester")
+        degrees = [mommy.make(Degree, name_en="First degree", order=1), mommy.make(Degree, name_en="Second degree", order=2)]
+        cls.course = mommy.make(Course, semester=cls.semester, name_en="Course", type__name_en="Type", degrees=degrees)
+        cls.question = mommy.make(Question, type="L", text_en="Question", questionnaire__name_en="Questionnaire")
+        cls.contribution = cls.course.general_contribution
+        mommy.make(RatingAnswerCounter, question=cls.question, contribution=cls.contribution, answer=1, count=2)
+        mommy.make(RatingAnswerCounter, question=cls.question, contribution=cls.contribution, answer=3, count=1)
+        mommy.make(RatingAnswerCounter, question=cls.question, contribution__course__semester=mommy.make(Semester, pk=2), answer=1, count=5)
+
+    def test_view_downloads_compressed_csv_file(self):
+        response = self.app.get(self.url, user='staff')
+        lines = gzip.decompress(response.body).decode("utf-8").split("\r\n")
+
+        self.assertEqual(lines[0], "semester_id;semester;course_id;course;course_type;course_state;is_graded;contribution_id;"
+            "contributor_id;questionnaire_id;questionnaire;question_id;question;question_type;answer;count;degrees")
+        self.assertEqual(lines[1], "int;str;int;str;str;str;bool;int;int;int;str;int;str;str;int;int;str")
+        expected_row = "1;Semester;{};Course;Type;new;True;{};;{};Questionnaire;{};Question;L;{};{};First degree, Second degree"
+        self.assertEqual(lines[2:], [
+            expected_row.format(self.course.id, self.contribution.id, self.question.questionnaire.id, self.question.id, 1, 2),
+            expected_row.format(self.course.id, self.contribution.id, self.question.questionnaire.id, self.question.id, 3, 1),
+            "",
+        ])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestSemesterExportJobsView(ViewTest):
+    url = '/staff/semester/1/export_jobs'
+    test_users = ['staff']
+
+    @classmethod
+    def setUpTestData(cls):
+        mommy.make(UserProfile, username='staff', groups=[Group.objects.get(name='Staff')])
+        cls.student_user = mommy.make(UserProfile, username='student')
+        cls.semester = mommy.make(Semester, pk=1, name_en="Semester", name_de="Semester")
+        cls.course_type = mommy.make(CourseType, name_en="Type")
+        cls.course = mommy.make(Course, type=cls.course_type, semester=cls.semester, participants=[cls.student_user],
+            name_de="Veranstaltung 1", name_en="Course 1")
+
+    def queue_raw_export(self):
+        self.app.get(self.url, user='staff').forms['export-job-form'].submit(name='export_type', value='raw')
+
+    def test_export_job(self):
+        page = self.app.get(self.url, user='staff')
+        page.forms['export-job-form'].submit(name='export_type', value='participation').follow()
+        job = ExportJob.objects.get()
+        self.assertEqual(job.state, ExportJob.QUEUED)
+
+        status_url = reverse('staff:export_job_status', args=[self.semester.id, job.id])
+        self.assertEqual(self.app.get(status_url, user='staff').json, dict(state=ExportJob.QUEUED, progress=0, is_finished=False))
+
+        management.call_command('run_export_jobs')
+        job.refresh_from_db()
+        self.assertEqual(job.state, ExportJob.DONE)
+        self.assertTrue(job.filename.endswith('_participation.csv'))
+        self.assertEqual(self.app.get(status_url, user='staff').json, dict(state=ExportJob.DONE, progress=100, is_finished=True))
+
+        response = self.app.get(reverse('staff:export_job_download', args=[self.semester.id, job.id]), user='staff')
+        self.assertEqual(response.body, self.app.get('/staff/semester/1/participation_export', user='staff').body)
+
+    def test_export_jobs_are_reused_until_data_changes(self):
+        self.queue_raw_export()
+        self.queue_raw_export()
+        self.assertEqual(ExportJob.objects.count(), 1)
+
+        management.call_command('run_export_jobs')
+        self.queue_raw_export()
+        self.assertEqual(ExportJob.objects.count(), 1)
+
+        self.course.save()
+        self.queue_raw_export()
+        self.assertEqual(ExportJob.objects.count(), 2)
+
+    def test_participation_export_jobs_are_not_reused_after_enrollment_changes(self):
+        form = self.app.get(self.url, user='staff').forms['export-job-form']
+        form.submit(name='export_type', value='participation')
+        self.course.participants.add(mommy.make(UserProfile))
+        form.submit(name='export_type', value='participation')
+        self.assertEqual(ExportJob.objects.count(), 2)
+
+    def test_results_export_can_be_queued(self):
+        page = self.app.get('/staff/semester/1/export', user='staff')
+        form = page.forms["semester-export-form"]
+        form.set('form-0-selected_course_types', 'id_form-0-selected_course_types_0')
+        form['file_format'] = 'xlsx'
+        form.submit(name='background').follow()
+
+        management.call_command('run_export_jobs')
+        job = ExportJob.objects.get()
+        self.assertEqual((job.export_type, job.state), (ExportJob.RESULTS_XLSX, ExportJob.DONE))
+        workbook = xlrd.open_workbook(file_contents=job.file.read())
+        self.assertEqual(workbook.sheets()[0].row_values(0)[0], 'Evaluation {0}\n\n{1}'.format(self.semester.name, self.course_type.name))
+
 
 class TestCourseOperationView(ViewTest):
     url = '/staff/semester/1/courseoperation'
@@ -719,6 +950,19 @@ class TestCourseOperationView(ViewTest):
         course = mommy.make(Course, semester=self.semester, state='reviewed')
         self.helper_semester_state_views(course, "reviewed", "published")
 
+    def test_semester_publish_warms_up_results(self):
+        course = mommy.make(Course, semester=self.semester, state='reviewed')
+        other_course = mommy.make(Course, semester=self.semester, state='published')
+        mommy.make(Course, semester=mommy.make(Semester, pk=2), state='published')
+        cache.clear()
+
+        response = self.app.get(self.url + '?course={}&target_state=published'.format(course.pk), user='staff')
+        response.forms['course-operation-form'].submit()
+
+        self.assertIsNotNone(cache.get(get_results_cache_key(Course.objects.get(pk=course.pk))))
+        self.assertEqual(set(CourseGrades.objects.values_list('course_id', flat=True)), {course.id, other_course.id})
+        self.assertEqual(get_courses_to_warm_up().count(), 1)
+
     def test_semester_reset_1(self):
         course = mommy.make(Course, semester=self.semester, state='prepared')
         self.helper_semester_state_views(course, "prepared", "new")
@@ -1482,10 +1726,12 @@ class TestCourseCommentsUpdatePublishView(WebTest):
 
     def helper(self, old_state, expected_new_state, action):
         textanswer = mommy.make(TextAnswer, state=old_state)
+        answer_data_version = Course.objects.get(pk=self.course.pk).answer_data_version
         response = self.app.post(self.url, params={"id": textanswer.id, "action": action, "course_id": self.course.pk}, user="staff.user")
         self.assertEqual(response.status_code, 200)
         textanswer.refresh_from_db()
         self.assertEqual(textanswer.state, expected_new_state)
+        self.assertEqual(Course.objects.get(pk=self.course.pk).answer_data_version, answer_data_version + 1)
 
     def test_review_actions(self):
         self.helper(TextAnswer.NOT_REVIEWED, TextAnswer.PUBLISHED, "publish")
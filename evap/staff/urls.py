@@ -11,12 +11,17 @@ urlpatterns = [
 
     path("semester/", RedirectView.as_view(url='/staff/', permanent=True)),
     path("semester/create", views.semester_create, name="semester_create"),
+    path("semester/comparison_export", views.semester_comparison_export, name="semester_comparison_export"),
     path("semester/<int:semester_id>", views.semester_view, name="semester_view"),
     path("semester/<int:semester_id>/edit", views.semester_edit, name="semester_edit"),
     path("semester/<int:semester_id>/import", views.semester_import, name="semester_import"),
     path("semester/<int:semester_id>/export", views.semester_export, name="semester_export"),
     path("semester/<int:semester_id>/raw_export", views.semester_raw_export, name="semester_raw_export"),
     path("semester/<int:semester_id>/participation_export", views.semester_participation_export, name="semester_participation_export"),
+    path("semester/<int:semester_id>/analytics_export", views.semester_analytics_export, name="semester_analytics_export"),
+    path("semester/<int:semester_id>/export_jobs", views.semester_export_jobs, name="semester_export_jobs"),
+    path("semester/<int:semester_id>/export_job/<int:export_job_id>/status", views.export_job_status, name="export_job_status"),
+    path("semester/<int:semester_id>/export_job/<int:export_job_id>/download", views.export_job_download, name="export_job_download"),
     path("semester/<int:semester_id>/assign", views.semester_questionnaire_assign, name="semester_questionnaire_assign"),
     path("semester/<int:semester_id>/todo", views.semester_todo, name="semester_todo"),
     path("semester/<int:semester_id>/course/create", views.course_create, name="course_create"),
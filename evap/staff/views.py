@@ -1,5 +1,5 @@
-import csv
 from datetime import datetime, date
+import tempfile
 from xlrd import open_workbook as open_workbook
 from xlutils.copy import copy as copy_workbook
 from collections import OrderedDict, defaultdict
@@ -11,26 +11,31 @@ from django.db import IntegrityError, transaction
 from django.db.models import BooleanField, Case, Count, ExpressionWrapper, IntegerField, Max, Prefetch, Q, Sum, When
 from django.forms import formset_factory
 from django.forms.models import inlineformset_factory, modelformset_factory
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils.translation import ugettext as _
 from django.utils.translation import get_language, ungettext
 from django.views.decorators.http import require_POST
+
+from sendfile import sendfile
+
 from evap.evaluation.auth import reviewer_required, staff_required
-from evap.evaluation.models import (Contribution, Course, CourseType, Degree, EmailTemplate, FaqQuestion, FaqSection, Question, Questionnaire,
+from evap.evaluation.models import (Contribution, Course, CourseType, Degree, EmailTemplate, ExportJob, FaqQuestion, FaqSection, Question, Questionnaire,
                                     RatingAnswerCounter, Semester, TextAnswer, UserProfile)
-from evap.evaluation.tools import STATES_ORDERED, questionnaires_and_contributions, send_publish_notifications, sort_formset
+from evap.evaluation.tools import (STATES_ORDERED, add_validators, get_etag, get_not_modified_response, questionnaires_and_contributions,
+                                  send_publish_notifications, sort_formset)
 from evap.grades.tools import are_grades_activated
 from evap.grades.models import GradeDocument
-from evap.results.exporters import ExcelExporter
-from evap.results.tools import CommentSection, TextResult, calculate_average_grades_and_deviation, get_textanswers
-from evap.rewards.models import RewardPointGranting
-from evap.rewards.tools import can_user_use_reward_points, is_semester_activated
+from evap.results.exporters import SemesterComparisonExporter, SemesterComparisonXlsxExporter
+from evap.results.tools import CommentSection, TextResult, get_textanswers, warm_up_published_courses
+from evap.rewards.tools import is_semester_activated
 from evap.staff.forms import (AtLeastOneFormSet, ContributionForm, ContributionFormSet, CourseEmailForm, CourseForm, CourseParticipantCopyForm,
                               CourseTypeForm, CourseTypeMergeSelectionForm, DegreeForm, EmailTemplateForm, ExportSheetForm, FaqQuestionForm,
                               FaqSectionForm, ImportForm, QuestionForm, QuestionnaireForm, QuestionnairesAssignForm, RemindResponsibleForm,
-                              SemesterForm, SingleResultForm, TextAnswerForm, UserBulkDeleteForm, UserForm, UserImportForm, UserMergeSelectionForm)
+                              SemesterComparisonExportForm, SemesterForm, SingleResultForm, TextAnswerForm, UserBulkDeleteForm, UserForm, UserImportForm, UserMergeSelectionForm)
+from evap.staff.exporters import (export_filename, get_cached_export, get_export_data_version, get_export_names_version, participation_export_rows,
+                                  queue_export_job, raw_export_rows, stream_analytics, stream_csv)
 from evap.staff.importers import EnrollmentImporter, UserImporter, PersonImporter
 from evap.staff.tools import (bulk_delete_users, custom_redirect, delete_import_file, delete_navbar_cache, forward_messages,
                               get_import_file_content_or_raise, import_file_exists, merge_users, save_import_file,
@@ -274,6 +279,7 @@ def helper_semester_course_operation_publish(request, courses, template):
         course.save()
     messages.success(request, ungettext("Successfully published %(courses)d course.",
         "Successfully published %(courses)d courses.", len(courses)) % {'courses': len(courses)})
+    warm_up_published_courses(courses)
     if template:
         send_publish_notifications(courses, template)
 
@@ -387,64 +393,123 @@ def semester_export(request, semester_id):
             if 'selected_course_types' in form.cleaned_data:
                 course_types_list.append(form.cleaned_data['selected_course_types'])
 
-        filename = "Evaluation-{}-{}.xls".format(semester.name, get_language())
-        response = HttpResponse(content_type="application/vnd.ms-excel")
-        response["Content-Disposition"] = "attachment; filename=\"{}\"".format(filename)
-        ExcelExporter(semester).export(response, course_types_list, include_not_enough_answers, include_unpublished)
-        return response
+        export_type = ExportJob.RESULTS_XLSX if request.POST.get('file_format') == 'xlsx' else ExportJob.RESULTS_XLS
+        parameters = dict(course_types_list=course_types_list, include_not_enough_answers=include_not_enough_answers, include_unpublished=include_unpublished)
+
+        if 'background' in request.POST:
+            queue_export_job(semester, export_type, parameters, request.user)
+            messages.success(request, _("The export has been queued."))
+            return redirect('staff:semester_export_jobs', semester.id)
+
+        # repeated requests for an unchanged semester are served from the file created by the first one
+        path = get_cached_export(semester, export_type, parameters)
+        return sendfile(request, path, attachment=True, attachment_filename=export_filename(semester, export_type))
     else:
         return render(request, "staff_semester_export.html", dict(semester=semester, formset=formset))
 
 
+@staff_required
+def semester_comparison_export(request):
+    form = SemesterComparisonExportForm(request.POST or None)
+
+    if form.is_valid():
+        if form.cleaned_data['file_format'] == 'xlsx':
+            exporter = SemesterComparisonXlsxExporter(form.cleaned_data['semesters'])
+            content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        else:
+            exporter = SemesterComparisonExporter(form.cleaned_data['semesters'])
+            content_type = "application/vnd.ms-excel"
+        output = tempfile.TemporaryFile()
+        course_type_ids = [course_type.id for course_type in form.cleaned_data['course_types']]
+        exporter.export(output, [course_type_ids], form.cleaned_data['include_not_enough_answers'], form.cleaned_data['include_unpublished'])
+        output.seek(0)
+
+        response = FileResponse(output, content_type=content_type)
+        response["Content-Disposition"] = "attachment; filename=\"Evaluation-Comparison-{}.{}\"".format(get_language(), form.cleaned_data['file_format'])
+        return response
+    else:
+        return render(request, "staff_semester_comparison_export.html", dict(form=form))
+
+
 @staff_required
 def semester_raw_export(request, semester_id):
     semester = get_object_or_404(Semester, id=semester_id)
 
-    filename = "Evaluation-{}-{}_raw.csv".format(semester.name, get_language())
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = "attachment; filename=\"{}\"".format(filename)
+    include_answer_counters = request.GET.get('include_answer_counters') == 'on'
 
-    writer = csv.writer(response, delimiter=";")
-    writer.writerow([_('Name'), _('Degrees'), _('Type'), _('Single result'), _('State'), _('#Voters'),
-        _('#Participants'), _('#Comments'), _('Average grade')])
-    for course in semester.course_set.all():
-        degrees = ", ".join([degree.name for degree in course.degrees.all()])
-        course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation(course)
-        if course.state in ['evaluated', 'reviewed', 'published'] and course.avg_grade is not None:
-            avg_grade = "{:.1f}".format(course.avg_grade)
-        else:
-            avg_grade = ""
-        writer.writerow([course.name, degrees, course.type.name, course.is_single_result, course.state,
-            course.num_voters, course.num_participants, course.textanswer_set.count(), avg_grade])
+    etag = get_etag(get_export_data_version(semester, ExportJob.RAW), get_language(), include_answer_counters)
+    not_modified_response = get_not_modified_response(request, etag)
+    if not_modified_response:
+        return not_modified_response
 
-    return response
+    response = StreamingHttpResponse(stream_csv(raw_export_rows(semester, include_answer_counters)), content_type="text/csv")
+    response["Content-Disposition"] = "attachment; filename=\"{}\"".format(export_filename(semester, ExportJob.RAW))
+    return add_validators(response, etag)
 
 
 @staff_required
 def semester_participation_export(request, semester_id):
     semester = get_object_or_404(Semester, id=semester_id)
-    participants = UserProfile.objects.filter(courses_participating_in__semester=semester).distinct().order_by("username")
 
-    filename = "Evaluation-{}-{}_participation.csv".format(semester.name, get_language())
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = "attachment; filename=\"{}\"".format(filename)
+    etag = get_etag(get_export_data_version(semester, ExportJob.PARTICIPATION), get_language())
+    not_modified_response = get_not_modified_response(request, etag)
+    if not_modified_response:
+        return not_modified_response
 
-    writer = csv.writer(response, delimiter=";")
-    writer.writerow([_('Username'), _('Can use reward points'), _('#Required courses voted for'),
-        _('#Required courses'), _('#Optional courses voted for'), _('#Optional courses'), _('Earned reward points')])
-    for participant in participants:
-        number_of_required_courses = semester.course_set.filter(participants=participant, is_required_for_reward=True).count()
-        number_of_required_courses_voted_for = semester.course_set.filter(voters=participant, is_required_for_reward=True).count()
-        number_of_optional_courses = semester.course_set.filter(participants=participant, is_required_for_reward=False).count()
-        number_of_optional_courses_voted_for = semester.course_set.filter(voters=participant, is_required_for_reward=False).count()
-        earned_reward_points = RewardPointGranting.objects.filter(semester=semester, user_profile=participant).exists()
-        writer.writerow([
-            participant.username, can_user_use_reward_points(participant), number_of_required_courses_voted_for,
-            number_of_required_courses, number_of_optional_courses_voted_for, number_of_optional_courses,
-            earned_reward_points
-        ])
+    response = StreamingHttpResponse(stream_csv(participation_export_rows(semester)), content_type="text/csv")
+    response["Content-Disposition"] = "attachment; filename=\"{}\"".format(export_filename(semester, ExportJob.PARTICIPATION))
+    return add_validators(response, etag)
 
-    return response
+
+@staff_required
+def semester_analytics_export(request, semester_id):
+    semester = get_object_or_404(Semester, id=semester_id)
+
+    # the dump only contains English names, so it doesn't depend on the language
+    etag = get_etag(semester.data_version, get_export_names_version())
+    not_modified_response = get_not_modified_response(request, etag)
+    if not_modified_response:
+        return not_modified_response
+
+    response = StreamingHttpResponse(stream_analytics([semester]), content_type="application/gzip")
+    response["Content-Disposition"] = "attachment; filename=\"Evaluation-{}_analytics.csv.gz\"".format(semester.name)
+    return add_validators(response, etag)
+
+
+@staff_required
+def semester_export_jobs(request, semester_id):
+    semester = get_object_or_404(Semester, id=semester_id)
+
+    if request.method == "POST":
+        export_type = request.POST.get("export_type")
+        if export_type not in [ExportJob.RAW, ExportJob.PARTICIPATION]:
+            raise SuspiciousOperation("Invalid export type")
+        queue_export_job(semester, export_type, {}, request.user)
+        messages.success(request, _("The export has been queued."))
+        return redirect('staff:semester_export_jobs', semester.id)
+
+    template_data = dict(semester=semester, export_jobs=semester.export_jobs.all())
+    return render(request, "staff_semester_export_jobs.html", template_data)
+
+
+@staff_required
+def export_job_status(request, semester_id, export_job_id):
+    export_job = get_object_or_404(ExportJob, id=export_job_id, semester_id=semester_id)
+    return JsonResponse(dict(state=export_job.state, progress=export_job.progress, is_finished=export_job.is_finished))
+
+
+@staff_required
+def export_job_download(request, semester_id, export_job_id):
+    export_job = get_object_or_404(ExportJob, id=export_job_id, semester_id=semester_id, state=ExportJob.DONE)
+
+    # the file of a job never changes once it is done
+    etag = get_etag(export_job.id, export_job.finished_at)
+    not_modified_response = get_not_modified_response(request, etag, export_job.finished_at)
+    if not_modified_response:
+        return not_modified_response
+
+    response = sendfile(request, export_job.file.path, attachment=True, attachment_filename=export_job.filename)
+    return add_validators(response, etag, export_job.finished_at)
 
 
 @staff_required
@@ -765,6 +830,7 @@ def course_comments_update_publish(request):
     else:
         return HttpResponse(status=400)  # 400 Bad Request
     answer.save()
+    course.bump_answer_data_version()
 
     if course.state == "evaluated" and course.is_fully_reviewed:
         course.review_finished()
@@ -788,6 +854,7 @@ def course_comment_edit(request, semester_id, course_id, text_answer_id):
 
     if form.is_valid():
         form.save()
+        course.bump_answer_data_version()
         # jump to edited answer
         url = reverse('staff:course_comments', args=[semester_id, course_id]) + '#' + str(text_answer.id)
         return HttpResponseRedirect(url)
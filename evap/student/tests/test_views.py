@@ -1,10 +1,14 @@
+from unittest.mock import patch
+
 from django.contrib.auth.models import Group
+from django.core.cache import cache
 from django.test.utils import override_settings
 from django.urls import reverse
 from model_mommy import mommy
 
 from evap.evaluation.models import UserProfile, Course, Questionnaire, Question, Contribution, TextAnswer, RatingAnswerCounter
 from evap.evaluation.tests.tools import WebTest, ViewTest
+from evap.results.tools import get_answer_counts, get_answer_counts_cache_key
 from evap.student.tools import question_id
 from evap.student.views import SUCCESS_MAGIC_STRING
 
@@ -125,6 +129,42 @@ class TestVoteView(ViewTest):
         self.assertEqual(list(TextAnswer.objects.filter(question=self.contributor_text_question, contribution=self.contribution2).values_list('original_answer', flat=True)), ["some more text"]*2)
         self.assertEqual(list(TextAnswer.objects.filter(question=self.general_text_question, contribution=self.course.general_contribution).values_list('original_answer', flat=True)), ["some text"]*2)
 
+    def test_answer_counts_are_updated_incrementally(self):
+        course = Course.objects.get(pk=self.course.pk)
+        get_answer_counts([course])
+
+        page = self.get_assert_200(self.url, user=self.voting_user1.username)
+        form = page.forms["student-vote-form"]
+        self.fill_form(form, fill_complete=True)
+        # the test case's transaction is never committed, so the on_commit callbacks are run right away
+        with patch('django.db.transaction.on_commit', side_effect=lambda func: func()):
+            form.submit()
+
+        previous_version = course.answer_data_version
+        course = Course.objects.get(pk=self.course.pk)
+        self.assertEqual(course.answer_data_version, previous_version + 1)
+        self.assertIsNone(cache.get(get_answer_counts_cache_key(course.id, previous_version, course.last_modified_time)))
+        with patch('evap.results.tools.RatingAnswerCounter.objects.filter') as filter_mock:
+            answer_counts = get_answer_counts([course])[course.id]
+        self.assertFalse(filter_mock.called)
+        self.assertEqual(answer_counts[(self.course.general_contribution.id, self.general_likert_question.id)], (1, 0, 0, 0, 0))
+        self.assertEqual(answer_counts[(self.course.general_contribution.id, self.general_grade_question.id)], (0, 0, 1, 0, 0))
+        self.assertEqual(answer_counts[(self.contribution1.id, self.contributor_likert_question.id)], (0, 0, 0, 1, 0))
+        self.assertEqual(answer_counts[(self.contribution2.id, self.contributor_likert_question.id)], (0, 1, 0, 0, 0))
+
+    def test_answer_counts_are_updated_on_commit(self):
+        course = Course.objects.get(pk=self.course.pk)
+        get_answer_counts([course])
+
+        page = self.get_assert_200(self.url, user=self.voting_user1.username)
+        form = page.forms["student-vote-form"]
+        self.fill_form(form, fill_complete=True)
+        with patch('django.db.transaction.on_commit') as on_commit_mock:
+            form.submit()
+
+        self.assertEqual(on_commit_mock.call_count, 1)
+        course = Course.objects.get(pk=self.course.pk)
+        self.assertIsNone(cache.get(get_answer_counts_cache_key(course.id, course.answer_data_version, course.last_modified_time)))
 
     def test_user_cannot_vote_multiple_times(self):
         page = self.get_assert_200(self.url, user=self.voting_user1.username)
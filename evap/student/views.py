@@ -11,6 +11,7 @@ from django.utils.translation import ugettext as _
 from evap.evaluation.auth import participant_required
 from evap.evaluation.models import Course, Semester
 from evap.evaluation.tools import STUDENT_STATES_ORDERED
+from evap.results.tools import add_votes_to_answer_counts
 
 from evap.student.forms import QuestionsForm
 from evap.student.tools import question_id
@@ -101,6 +102,10 @@ def vote(request, course_id):
         if not created:  # vote already got recorded, bail out
             raise SuspiciousOperation("A second vote has been received shortly after the first one.")
 
+        # this locks the course, so the answer counters and the cached answer counts are updated by one vote at a time
+        course.bump_answer_data_version()
+        votes = []
+
         for contribution, form_group in form_groups.items():
             for questionnaire_form in form_group:
                 questionnaire = questionnaire_form.questionnaire
@@ -121,9 +126,12 @@ def vote(request, course_id):
                             answer_counter, __ = question.answer_class.objects.get_or_create(contribution=contribution, question=question, answer=value)
                             answer_counter.add_vote()
                             answer_counter.save()
+                            votes.append((contribution.id, question.id, value))
 
         course.course_evaluated.send(sender=Course, request=request, semester=course.semester)
 
+        add_votes_to_answer_counts(course, votes)
+
     messages.success(request, _("Your vote was recorded."))
     return HttpResponse(SUCCESS_MAGIC_STRING)
 